@@ -0,0 +1,98 @@
+import sys
+import time
+from pathlib import Path
+from typing import List
+from utils.extraction import LOCAL_PDF_TIMEOUT, extract_pdf_text
+from utils.text_embedding_generator import TextEmbeddingGenerator
+
+# Sample row instructions repeated when no files are given
+SAMPLE_TEXT = (
+    "Row 1 (RS): K2, *p2, k2; rep from * to end.\n"
+    "Row 2: P2, *k2, p2; rep from * to end. Repeat rows 1-2 until piece "
+    "measures 5 cm from cast-on edge, ending with a WS row.\n"
+)
+
+
+def legacy_chunk_text(generator: TextEmbeddingGenerator, text: str) -> List[str]:
+    """
+    The previous chunker: decodes every window, searches it for the last
+    period and encodes the prefix again to find the token boundary. Its
+    chunks differ from the streaming chunker's, so the chunk counts differ.
+    """
+    encoding = generator.encoding
+    tokens = encoding.encode(text)
+    chunks = []
+
+    start_idx = 0
+    while start_idx < len(tokens):
+        end_idx = start_idx + generator.chunk_size
+
+        if end_idx >= len(tokens):
+            chunks.append(encoding.decode(tokens[start_idx:]))
+            break
+
+        decode_chunk = encoding.decode(tokens[start_idx:end_idx])
+        last_period = decode_chunk.rfind(".")
+        if last_period != -1:
+            partial_chunk = decode_chunk[: last_period + 1]
+            end_idx = start_idx + len(encoding.encode(partial_chunk))
+
+        chunks.append(encoding.decode(tokens[start_idx:end_idx]))
+        start_idx = end_idx - generator.chunk_overlap
+
+    return chunks
+
+
+def load_text(path: Path) -> str:
+    if path.suffix.lower() == ".pdf":
+        text, _ = extract_pdf_text(path.read_bytes(), LOCAL_PDF_TIMEOUT)
+        return text
+    return path.read_text(encoding="utf-8", errors="ignore")
+
+
+def time_chunker(chunker, texts: List[str], repeat: int):
+    """
+    Returns:
+        Tuple[float, int]: Best time over `repeat` runs and the number of chunks
+    """
+    best = float("inf")
+    chunk_count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunk_count = sum(len(chunker(text)) for text in texts)
+        best = min(best, time.perf_counter() - start)
+    return best, chunk_count
+
+
+def main(paths: List[str], repeat: int = 3):
+    """
+    Compare the legacy and the streaming chunker on PDFs or text files.
+
+    Args:
+        paths: PDF or text files, a large synthetic text is used if empty
+        repeat: Number of runs per chunker, the best one is reported
+    """
+    if paths:
+        texts = [load_text(Path(path)) for path in paths]
+    else:
+        texts = [SAMPLE_TEXT * 20000]
+    print(f"{len(texts)} texts, {sum(len(text) for text in texts)} characters")
+
+    generator = TextEmbeddingGenerator(api_key="benchmark")
+    legacy_time, legacy_chunks = time_chunker(
+        lambda text: legacy_chunk_text(generator, text), texts, repeat
+    )
+    print(f"legacy:    {legacy_time:.3f}s, {legacy_chunks} chunks")
+    for rules in (("sentence",), ("row", "sentence", "newline")):
+        generator = TextEmbeddingGenerator(api_key="benchmark", boundary_rules=rules)
+        streaming_time, streaming_chunks = time_chunker(
+            generator.chunk_text, texts, repeat
+        )
+        print(
+            f"streaming ({', '.join(rules)}): {streaming_time:.3f}s, "
+            f"{streaming_chunks} chunks, {legacy_time / streaming_time:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
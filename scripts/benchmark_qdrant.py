@@ -0,0 +1,195 @@
+import argparse
+import time
+from typing import Dict
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import CollectionStatus, OptimizersConfigDiff, PointStruct
+from utils.qdrant import (
+    COLLECTION_NAME,
+    COLLECTION_PROFILES,
+    VECTOR_SIZE,
+    collection_config,
+    profile_dimensions,
+    search_params,
+)
+
+BENCHMARK_COLLECTION = "benchmark_profile"
+TOP_K = 10
+DEFAULT_HNSW_M = 16
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def synthetic_vectors(count: int, seed: int = 0) -> np.ndarray:
+    """
+    Clustered unit vectors, closer to real embeddings than uniform noise.
+    Their information is spread over all dimensions, so shortened profiles
+    score lower on them than on real text-embedding-3 vectors.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = rng.normal(size=(max(1, count // 100), VECTOR_SIZE))
+    labels = rng.integers(len(centroids), size=count)
+    vectors = centroids[labels] + 0.5 * rng.normal(size=(count, VECTOR_SIZE))
+    return normalize(vectors).astype(np.float32)
+
+
+def collection_vectors(qdrant_client: QdrantClient, collection_name: str, count: int) -> np.ndarray:
+    """
+    Read up to `count` vectors of an existing collection
+    """
+    vectors = []
+    offset = None
+    while len(vectors) < count:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=min(1000, count - len(vectors)),
+            offset=offset,
+            with_payload=False,
+            with_vectors=True,
+        )
+        vectors.extend(point.vector for point in points)
+        if offset is None:
+            break
+    return normalize(np.asarray(vectors, dtype=np.float32))
+
+
+def shorten(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    # Same as the `dimensions` parameter of text-embedding-3: truncate, renormalize
+    return normalize(vectors[:, :dimensions])
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int = TOP_K) -> np.ndarray:
+    scores = queries @ vectors.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def estimate_memory(profile: str, count: int) -> Dict[str, float]:
+    """
+    Estimated RAM and disk footprint of a profile in MB: original vectors,
+    quantized vectors and the HNSW links (2 * m per point on the base layer)
+    """
+    settings = COLLECTION_PROFILES[profile]
+    dimensions = profile_dimensions(profile)
+    originals = count * dimensions * 4
+    quantized = {"int8": count * dimensions, "binary": count * dimensions / 8}.get(
+        settings.get("quantization"), 0
+    )
+    graph = count * 2 * settings.get("m", DEFAULT_HNSW_M) * 4
+    ram = quantized + graph + (0 if settings.get("on_disk") else originals)
+    disk = originals if settings.get("on_disk") else 0
+    return {"ram_mb": ram / 1024**2, "disk_mb": disk / 1024**2}
+
+
+def wait_for_index(qdrant_client: QdrantClient, collection_name: str, timeout: int = 600):
+    start = time.time()
+    while qdrant_client.get_collection(collection_name).status != CollectionStatus.GREEN:
+        if time.time() - start > timeout:
+            print("Index still building, measuring anyway")
+            return
+        time.sleep(1)
+
+
+def benchmark_profile(
+    qdrant_client: QdrantClient,
+    profile: str,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    expected: np.ndarray,
+) -> Dict[str, float]:
+    """
+    Load the vectors into a collection created with a profile and measure
+    search latency and recall@10 against the exact results.
+    """
+    dimensions = profile_dimensions(profile)
+    data = shorten(vectors, dimensions)
+    query_vectors = shorten(queries, dimensions)
+
+    if qdrant_client.collection_exists(BENCHMARK_COLLECTION):
+        qdrant_client.delete_collection(BENCHMARK_COLLECTION)
+    qdrant_client.create_collection(
+        collection_name=BENCHMARK_COLLECTION,
+        # Build the index right away, even for small samples
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=1),
+        **collection_config(profile),
+    )
+    for start in range(0, len(data), 512):
+        qdrant_client.upsert(
+            collection_name=BENCHMARK_COLLECTION,
+            points=[
+                PointStruct(id=i, vector=data[i].tolist())
+                for i in range(start, min(start + 512, len(data)))
+            ],
+            wait=True,
+        )
+    wait_for_index(qdrant_client, BENCHMARK_COLLECTION)
+
+    params = search_params(profile)
+    latencies = []
+    hits = 0
+    for query, truth in zip(query_vectors, expected):
+        begin = time.perf_counter()
+        result = qdrant_client.query_points(
+            collection_name=BENCHMARK_COLLECTION,
+            query=query.tolist(),
+            limit=TOP_K,
+            search_params=params,
+            with_payload=False,
+        )
+        latencies.append(time.perf_counter() - begin)
+        hits += len({point.id for point in result.points} & set(truth.tolist()))
+
+    qdrant_client.delete_collection(BENCHMARK_COLLECTION)
+    return {
+        **estimate_memory(profile, len(vectors)),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "recall": hits / (len(expected) * TOP_K),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare COLLECTION_PROFILES on memory, search latency and recall@10"
+    )
+    parser.add_argument("--url", help="Qdrant instance to benchmark, in-process if omitted")
+    parser.add_argument("--points", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument(
+        "--from-collection",
+        nargs="?",
+        const=COLLECTION_NAME,
+        help="Sample vectors from this collection of --url instead of synthetic ones",
+    )
+    parser.add_argument("--profiles", nargs="*", default=list(COLLECTION_PROFILES))
+    args = parser.parse_args()
+
+    qdrant_client = QdrantClient(url=args.url) if args.url else QdrantClient(":memory:")
+    if not args.url:
+        print("In-process Qdrant searches exactly: quantization and HNSW settings only show in the memory estimate")
+
+    if args.from_collection:
+        vectors = collection_vectors(qdrant_client, args.from_collection, args.points)
+    else:
+        vectors = synthetic_vectors(args.points)
+    rng = np.random.default_rng(1)
+    # Queries near stored points, like a search for a similar pattern
+    picked = vectors[rng.integers(len(vectors), size=args.queries)]
+    queries = normalize(picked + 0.05 * rng.normal(size=picked.shape)).astype(np.float32)
+    # The exact baseline always uses the full size vectors
+    expected = exact_top_k(vectors, queries)
+
+    print(f"{len(vectors)} points, {len(queries)} queries")
+    print(f"{'profile':<14}{'dims':>6}{'ram MB':>10}{'disk MB':>10}{'p50 ms':>9}{'p99 ms':>9}{'recall@10':>11}")
+    for profile in args.profiles:
+        stats = benchmark_profile(qdrant_client, profile, vectors, queries, expected)
+        print(
+            f"{profile:<14}{profile_dimensions(profile):>6}{stats['ram_mb']:>10.1f}"
+            f"{stats['disk_mb']:>10.1f}{stats['p50_ms']:>9.2f}{stats['p99_ms']:>9.2f}"
+            f"{stats['recall']:>11.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,73 +2,261 @@ import sqlite3
 import hashlib
 import json
 from datetime import date
+from typing import Optional
+from db.manifest import UPSERT_RAW_FILE, raw_file_row
+from db.sqlite import DB_PATH, VALIDATOR_COLUMNS, connect
+
+# Fields of the Ravelry response that preprocess_pattern and the scraper
+# read, except the ratings. Rating and difficulty averages, their counts and
+# the favorites/projects counters are stored with the pattern but move with
+# every vote, so they are left out: they are refreshed whenever a hashed
+# field changes, instead of triggering a re-scrape on their own.
+HASHED_FIELDS = (
+    "id",
+    "name",
+    "permalink",
+    "craft",
+    "free",
+    "languages",
+    "download_location",
+    "gauge",
+    "gauge_divisor",
+    "gauge_pattern",
+    "row_gauge",
+    "yardage",
+    "yardage_max",
+    "gauge_description",
+    "yarn_weight_description",
+    "yardage_description",
+    "pattern_needle_sizes",
+    "pattern_attributes",
+    "pattern_categories",
+)
+
+# Hashes are stored as "<scheme>:<digest>". Hashes without a prefix were
+# computed with the legacy "v1" scheme, a sha256 of the whole response.
+# "v2" is a blake2b of the HASHED_FIELDS serialized with the standard json
+# module. Only a few hundred bytes are hashed, so the serializer and the hash
+# function barely matter, and avoiding optional packages like orjson or
+# xxhash keeps hashes identical in every environment. Use a new scheme name
+# whenever HASHED_FIELDS or the serialization change.
+HASH_SCHEME = "v2"
+
+
+def canonical_json(data: dict) -> bytes:
+    """
+    Serialize the hashed fields of a pattern with sorted keys
+    """
+    selected = {field: data.get(field) for field in HASHED_FIELDS}
+    return json.dumps(
+        selected, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+def hash_scheme(hash_value: str) -> str:
+    """
+    Get the scheme a stored hash was computed with
+    """
+    return hash_value.split(":", 1)[0] if ":" in hash_value else "v1"
 
 
 # Function to hash API response
-def compute_hash(data: dict):
+def compute_hash(data: dict, scheme: str = HASH_SCHEME):
     """
     Compute the hash of the pattern
 
     Args:
         data (Pattern): pattern object
+        scheme (str): hash scheme, "v1" or "v2"
 
     Returns:
         str: The hash of the pattern
     """
-    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    if scheme == "v1":
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    if scheme == "v2":
+        digest = hashlib.blake2b(canonical_json(data), digest_size=16).hexdigest()
+        return f"{scheme}:{digest}"
+    raise ValueError(f"Unknown hash scheme: {scheme}")
 
 
-# Check if data has changed
-def data_has_changed(item_permalink, new_hash):
-    """
-    Check if the data has changed
+STORE_COLUMNS = ("hash", "last_checked", *VALIDATOR_COLUMNS)
+UPSERT_SCRAPED_PATTERN_ROW = f"""INSERT INTO scraped_patterns (id, {", ".join(STORE_COLUMNS)})
+        VALUES ({", ".join("?" * (len(STORE_COLUMNS) + 1))})
+        ON CONFLICT(id) DO UPDATE
+        SET {", ".join(f"{column} = excluded.{column}" for column in STORE_COLUMNS)}"""
+VALIDATOR_FIELDS = ("etag", "last_modified", "content_length")
 
-    Args:
-        item_id (str): the id of the pattern
-        new_hash (str): the new hash of the pattern
 
-    Returns:
-        bool: True if the data has changed, False otherwise
+class ScrapedPatternStore:
     """
-    conn = sqlite3.connect("db/scraper.db")
-    cursor = conn.cursor()
+    Long-lived view of the scraped_patterns table.
 
-    cursor.execute("SELECT hash FROM scraped_patterns WHERE id = ?", (item_permalink,))
-    result = cursor.fetchone()
+    Known rows are loaded into memory once, so change checks never touch
+    the disk. Updates are buffered and written in batches, one transaction
+    per batch.
+    """
 
-    conn.close()
+    def __init__(self, db_path: str = DB_PATH, batch_size: int = 500):
+        """
+        Args:
+            db_path (str): path to the scraper database
+            batch_size (int): number of buffered updates that triggers a flush
+        """
+        self.conn = connect(db_path)
+        self.batch_size = batch_size
+        self.rows = {
+            row[0]: dict(zip(STORE_COLUMNS, row[1:]))
+            for row in self.conn.execute(
+                f"SELECT id, {', '.join(STORE_COLUMNS)} FROM scraped_patterns"
+            )
+        }
+        self._pending = set()
+        self._pending_raw_files = {}
 
-    # If no existing record, it's new data
-    if not result:
-        return True
-    # If the hash is different, data has changed
-    return result[0] != new_hash
+    def _row(self, item_permalink: str) -> dict:
+        self._pending.add(item_permalink)
+        return self.rows.setdefault(
+            item_permalink, dict.fromkeys(STORE_COLUMNS)
+        )
 
+    def _maybe_flush(self):
+        if len(self._pending) + len(self._pending_raw_files) >= self.batch_size:
+            self.flush()
 
-# Store new hash in database
-def update_database(item_permalink: str, new_hash: str):
-    """
-    Updating database with latest hash for a given id
-    """
-    conn = sqlite3.connect("db/scraper.db")
-    cursor = conn.cursor()
+    def data_has_changed(
+        self, item_permalink: str, new_hash: str, data: dict = None
+    ) -> bool:
+        """
+        Check if the data has changed
 
-    cursor.execute(
-        """INSERT INTO scraped_patterns (id, hash, last_checked) 
-        VALUES (?, ?, ?) 
-        ON CONFLICT(id) DO UPDATE 
-        SET hash = excluded.hash, last_checked = excluded.last_checked""",
-        (item_permalink, new_hash, date.today()),
-    )
+        A hash stored with an older scheme is migrated when data is given:
+        the data is hashed again with the old scheme, and if it matches, the
+        stored hash is replaced without counting as a change.
+
+        Args:
+            item_permalink (str): the permalink of the pattern
+            new_hash (str): the new hash of the pattern
+            data (dict): the pattern the new hash was computed from
+
+        Returns:
+            bool: True if the data has changed, False otherwise
+        """
+        row = self.rows.get(item_permalink)
+        if row is None or row["hash"] is None:
+            return True
+        if row["hash"] == new_hash:
+            return False
+
+        old_scheme = hash_scheme(row["hash"])
+        if data is None or old_scheme == hash_scheme(new_hash):
+            return True
+        try:
+            unchanged = compute_hash(data, scheme=old_scheme) == row["hash"]
+        except ValueError:
+            return True
+        if unchanged:
+            # Keeps last_checked, so the pattern is not reprocessed
+            self._row(item_permalink)["hash"] = new_hash
+            self._maybe_flush()
+        return not unchanged
+
+    def update(self, item_permalink: str, new_hash: str):
+        """
+        Buffer the latest hash for a given permalink
+        """
+        row = self._row(item_permalink)
+        row["hash"] = new_hash
+        row["last_checked"] = str(date.today())
+        self._maybe_flush()
+
+    def get_validators(self, item_permalink: str, kind: str, url: str = None) -> dict:
+        """
+        Get the stored HTTP validators of the pattern JSON or the pattern file
+
+        Args:
+            item_permalink (str): the permalink of the pattern
+            kind (str): "json" or "file"
+            url (str): url of the file. Validators stored for another url are ignored
+
+        Returns:
+            dict: etag, last_modified and content_length, where known
+        """
+        row = self.rows.get(item_permalink)
+        if row is None or (kind == "file" and row["file_url"] != url):
+            return {}
+        return {
+            field: row[f"{kind}_{field}"]
+            for field in VALIDATOR_FIELDS
+            if row[f"{kind}_{field}"] is not None
+        }
+
+    def update_validators(
+        self, item_permalink: str, kind: str, validators: dict, url: str = None
+    ):
+        """
+        Buffer the HTTP validators of the pattern JSON or the pattern file.
+        This does not touch last_checked, so the pattern is not reprocessed.
+
+        Args:
+            item_permalink (str): the permalink of the pattern
+            kind (str): "json" or "file"
+            validators (dict): etag, last_modified and content_length
+            url (str): url of the file
+        """
+        row = self._row(item_permalink)
+        for field in VALIDATOR_FIELDS:
+            row[f"{kind}_{field}"] = validators.get(field)
+        if kind == "file":
+            row["file_url"] = url
+        self._maybe_flush()
+
+    def record_raw_file(
+        self, item_permalink: str, extension: str, size: int, content_hash: str
+    ):
+        """
+        Buffer the raw file manifest entry of a pattern file saved to S3
+        """
+        self._pending_raw_files[item_permalink] = raw_file_row(
+            item_permalink, extension, size, content_hash
+        )
+        self._maybe_flush()
+
+    def flush(self):
+        """
+        Write all buffered updates in a single transaction
+        """
+        if not self._pending and not self._pending_raw_files:
+            return
+        with self.conn:
+            self.conn.executemany(
+                UPSERT_SCRAPED_PATTERN_ROW,
+                [
+                    (item_permalink, *self.rows[item_permalink].values())
+                    for item_permalink in self._pending
+                ],
+            )
+            self.conn.executemany(UPSERT_RAW_FILE, self._pending_raw_files.values())
+        self._pending = set()
+        self._pending_raw_files = {}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
 
-    conn.commit()
-    conn.close()
 
 def fetch_latest_processed_patterns():
     """
     Fetch the latest processed patterns from the database
     """
-    conn = sqlite3.connect("db/scraper.db")
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute("SELECT distinct last_checked FROM scraped_patterns order by last_checked desc")
     latest_date = cursor.fetchone()[0]
@@ -76,4 +264,45 @@ def fetch_latest_processed_patterns():
     cursor.execute(f"select id from scraped_patterns where last_checked >= {latest_date}")
     processed_patterns = [row[0] for row in cursor.fetchall()]
     conn.close()
-    return processed_patterns
\ No newline at end of file
+    return processed_patterns
+
+class ExtractionCache:
+    """
+    Extracted texts keyed by the content hash of the raw file and the
+    extractor that produced them, so that identical files are never
+    extracted twice
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        self.conn = connect(db_path)
+
+    def get(self, content_hash: str, extractor: str) -> Optional[str]:
+        """
+        Returns:
+            str: The S3 key of the extracted text, or None if it is not cached
+        """
+        row = self.conn.execute(
+            "SELECT processed_key FROM extraction_cache WHERE content_hash = ? AND extractor = ?",
+            (content_hash, extractor),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, content_hash: str, extractor: str, processed_key: str):
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO extraction_cache (content_hash, extractor, processed_key, created_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(content_hash, extractor) DO UPDATE
+                SET processed_key = excluded.processed_key, created_at = excluded.created_at""",
+                (content_hash, extractor, processed_key, str(date.today())),
+            )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,203 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List, Optional
+from db.sqlite import DB_PATH, connect
+
+
+class CrawlCursors:
+    """
+    Crawl progress of every category, persisted in the crawl_cursors table so
+    that an interrupted crawl resumes from the last completed page.
+
+    Pages can complete out of order. The cursor only moves past a page once
+    every page before it has completed too.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, refresh_after: timedelta = timedelta(days=7)):
+        """
+        Args:
+            db_path (str): path to the scraper database
+            refresh_after (timedelta): age after which a fully crawled category
+                is crawled again from the first page
+        """
+        self.conn = connect(db_path)
+        self.refresh_after = refresh_after
+        self.cursors = {
+            row[0]: {"last_page": row[1], "total_pages": row[2], "updated_at": row[3]}
+            for row in self.conn.execute(
+                "SELECT category, last_page, total_pages, updated_at FROM crawl_cursors"
+            )
+        }
+        self._done_pages = defaultdict(set)
+
+    def next_page(self, category: str) -> Optional[int]:
+        """
+        Get the page to resume a category from
+
+        Returns:
+            int: The first page that has not been completed, or None if the
+            category was fully crawled recently
+        """
+        cursor = self.cursors.get(category)
+        if cursor is None:
+            return 1
+
+        is_complete = (
+            cursor["total_pages"] is not None
+            and cursor["last_page"] >= cursor["total_pages"]
+        )
+        if not is_complete:
+            return cursor["last_page"] + 1
+
+        updated_at = datetime.fromisoformat(cursor["updated_at"])
+        if datetime.now() - updated_at < self.refresh_after:
+            return None
+
+        # Start a fresh crawl of the category
+        cursor["last_page"] = 0
+        self._save(category)
+        return 1
+
+    def page_done(self, category: str, page: int, total_pages: int):
+        """
+        Record that a page of a category was crawled
+
+        Args:
+            category (str): the category
+            page (int): the completed page
+            total_pages (int): number of pages reported by the search paginator
+        """
+        cursor = self.cursors.setdefault(
+            category, {"last_page": 0, "total_pages": None, "updated_at": None}
+        )
+        done_pages = self._done_pages[category]
+        done_pages.add(page)
+        while cursor["last_page"] + 1 in done_pages:
+            cursor["last_page"] += 1
+            done_pages.remove(cursor["last_page"])
+        cursor["total_pages"] = total_pages
+        self._save(category)
+
+    def _save(self, category: str):
+        cursor = self.cursors[category]
+        cursor["updated_at"] = datetime.now().isoformat(timespec="seconds")
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO crawl_cursors (category, last_page, total_pages, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(category) DO UPDATE
+                SET last_page = excluded.last_page,
+                    total_pages = excluded.total_pages,
+                    updated_at = excluded.updated_at""",
+                (
+                    category,
+                    cursor["last_page"],
+                    cursor["total_pages"],
+                    cursor["updated_at"],
+                ),
+            )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class SeenPatterns:
+    """
+    Pattern ids already handled during the crawl, shared by every category
+    and page worker, so that a pattern listed in several categories is only
+    fetched once.
+
+    With a ttl, ids are also persisted in the seen_patterns table and ids
+    seen within the ttl are skipped by later runs too.
+    """
+
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        ttl: Optional[timedelta] = None,
+        batch_size: int = 500,
+    ):
+        """
+        Args:
+            db_path (str): path to the scraper database
+            ttl (timedelta): how long a persisted id is skipped, None to only
+                deduplicate within the run
+            batch_size (int): number of buffered ids that triggers a flush
+        """
+        self.seen = set()
+        self.conn = None
+        self.batch_size = batch_size
+        self._pending = []
+        if ttl is not None:
+            self.conn = connect(db_path)
+            cutoff = (datetime.now() - ttl).isoformat(timespec="seconds")
+            self.seen.update(
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT id FROM seen_patterns WHERE seen_at >= ?", (cutoff,)
+                )
+            )
+
+    def filter_new(self, pattern_ids: List[int]) -> List[int]:
+        """
+        Drop the ids that were already seen, and mark the others as seen
+
+        Returns:
+            List[int]: The ids seen for the first time
+        """
+        new_ids = []
+        for pattern_id in pattern_ids:
+            if pattern_id not in self.seen:
+                self.seen.add(pattern_id)
+                new_ids.append(pattern_id)
+        return new_ids
+
+    def forget(self, pattern_ids: List[int]):
+        """
+        Unmark ids that could not be handled, so a retry of their page fetches them
+        """
+        self.seen.difference_update(pattern_ids)
+
+    def persist(self, pattern_ids: List[int]):
+        """
+        Buffer ids that were handled successfully, to be skipped by later runs
+        """
+        if self.conn is None:
+            return
+        seen_at = datetime.now().isoformat(timespec="seconds")
+        self._pending.extend((pattern_id, seen_at) for pattern_id in pattern_ids)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered ids in a single transaction
+        """
+        if self.conn is None or not self._pending:
+            return
+        with self.conn:
+            self.conn.executemany(
+                """INSERT INTO seen_patterns (id, seen_at) VALUES (?, ?)
+                ON CONFLICT(id) DO UPDATE SET seen_at = excluded.seen_at""",
+                self._pending,
+            )
+        self._pending = []
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
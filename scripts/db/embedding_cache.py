@@ -0,0 +1,194 @@
+import hashlib
+import os
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+from db.sqlite import connect
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "db/embeddings.db")
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", 1024))
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def pack_vector(vector: List[float]) -> bytes:
+    # float32 is plenty for cosine similarity and halves the size of a double
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    Chunk embeddings keyed by the embedding model and the hash of the chunk
+    text, so unchanged chunks are never sent to the API twice.
+
+    The cache lives in its own database file and is capped at `max_bytes` of
+    vectors; the least recently used entries are evicted first. The file is
+    opened on first use, and one connection is shared by all threads under a
+    lock.
+    """
+
+    def __init__(
+        self,
+        db_path: str = EMBEDDING_CACHE_PATH,
+        max_bytes: int = int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024),
+    ):
+        """
+        Args:
+            db_path: Path of the SQLite file holding the cache
+            max_bytes: Maximum total size of the cached vectors
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._conn = None
+        # Reentrant, since put_many evicts while holding it
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        """
+        Connection to the cache file, opened on first use. Use with the lock held.
+        """
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = connect(self.db_path, check_same_thread=False)
+            with conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS embedding_cache (
+                        model TEXT,
+                        chunk_hash TEXT,
+                        vector BLOB,
+                        size INTEGER,
+                        last_used REAL,
+                        PRIMARY KEY (model, chunk_hash)
+                    )"""
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS embedding_cache_last_used ON embedding_cache (last_used)"
+                )
+            self.size = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM embedding_cache"
+            ).fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _select(self, column: str, model: str, hashes: List[str]):
+        """
+        Yield (chunk_hash, column) for the given chunk hashes that are cached
+        """
+        # Stay well below SQLite's limit on the number of query parameters
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start : start + 500]
+            yield from self.conn.execute(
+                f"""SELECT chunk_hash, {column} FROM embedding_cache
+                WHERE model = ? AND chunk_hash IN ({", ".join("?" * len(batch))})""",
+                (model, *batch),
+            )
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        """
+        Look up the embeddings of many chunks and mark the hits as used.
+
+        Returns:
+            Dict[str, List[float]]: Embedding by chunk hash, for the cached chunks only
+        """
+        hashes = list({chunk_hash(text) for text in texts})
+        with self._lock:
+            found = {
+                key: unpack_vector(blob)
+                for key, blob in self._select("vector", model, hashes)
+            }
+
+            if found:
+                now = time.time()
+                with self.conn:
+                    self.conn.executemany(
+                        "UPDATE embedding_cache SET last_used = ? WHERE model = ? AND chunk_hash = ?",
+                        [(now, model, key) for key in found],
+                    )
+        return found
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, [text]).get(chunk_hash(text))
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """
+        Store chunk embeddings, evicting the least recently used entries if
+        the cache grows over its size cap.
+        """
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            key = chunk_hash(text)
+            blob = pack_vector(vector)
+            rows[key] = (model, key, blob, len(blob), now)
+        if not rows:
+            return
+
+        with self._lock:
+            replaced = sum(size for _, size in self._select("size", model, list(rows)))
+            with self.conn:
+                self.conn.executemany(
+                    """INSERT INTO embedding_cache (model, chunk_hash, vector, size, last_used)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(model, chunk_hash) DO UPDATE
+                    SET vector = excluded.vector, size = excluded.size, last_used = excluded.last_used""",
+                    list(rows.values()),
+                )
+            self.size += sum(row[3] for row in rows.values()) - replaced
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def put(self, model: str, text: str, vector: List[float]):
+        self.put_many(model, [text], [vector])
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is 10% under
+        its size cap, so eviction does not run again on the next insert.
+        """
+        with self._lock:
+            target = self.max_bytes * 0.9
+            to_free = self.size - target
+            freed = 0
+            evicted = []
+            for model, key, size in self.conn.execute(
+                "SELECT model, chunk_hash, size FROM embedding_cache ORDER BY last_used"
+            ):
+                if freed >= to_free:
+                    break
+                evicted.append((model, key))
+                freed += size
+
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM embedding_cache WHERE model = ? AND chunk_hash = ?",
+                    evicted,
+                )
+            self.size -= freed
+        print(f"Evicted {len(evicted)} cached embeddings ({freed / 1024 / 1024:.1f}MB)")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,229 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List
+from db.sqlite import connect
+
+RAW_PREFIX = "raw/ravelry/"
+
+UPSERT_RAW_FILE = """INSERT INTO raw_manifest (permalink, file_key, extension, size, content_hash, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(permalink) DO UPDATE
+        SET file_key = excluded.file_key,
+            extension = excluded.extension,
+            size = excluded.size,
+            content_hash = excluded.content_hash,
+            updated_at = excluded.updated_at"""
+
+# Listings carry no content hash, keep the known one if the file looks unchanged
+UPSERT_LISTED_RAW_FILE = """INSERT INTO raw_manifest (permalink, file_key, extension, size, content_hash, updated_at)
+        VALUES (?, ?, ?, ?, NULL, ?)
+        ON CONFLICT(permalink) DO UPDATE
+        SET content_hash = CASE
+                WHEN raw_manifest.file_key = excluded.file_key
+                    AND raw_manifest.size = excluded.size
+                THEN raw_manifest.content_hash
+            END,
+            file_key = excluded.file_key,
+            extension = excluded.extension,
+            size = excluded.size,
+            updated_at = excluded.updated_at"""
+
+
+def raw_file_row(permalink: str, extension: str, size: int, content_hash: str) -> tuple:
+    """
+    Build the manifest row of a raw file saved by the scraper
+    """
+    return (
+        permalink,
+        f"{RAW_PREFIX}{permalink}/{permalink}.{extension}",
+        extension,
+        size,
+        content_hash,
+        datetime.now().isoformat(timespec="seconds"),
+    )
+
+
+def manifest_is_empty() -> bool:
+    conn = connect()
+    row = conn.execute("SELECT 1 FROM raw_manifest LIMIT 1").fetchone()
+    conn.close()
+    return row is None
+
+
+def fetch_raw_files(permalinks: List[str]) -> Dict[str, dict]:
+    """
+    Fetch the manifest entries of the raw files of the given patterns
+
+    Returns:
+        Dict[str, dict]: file_key, extension, size and content_hash of each
+        raw file, by permalink. Patterns without a raw file are left out.
+    """
+    conn = connect()
+    raw_files = {}
+    for i in range(0, len(permalinks), 500):
+        batch = permalinks[i : i + 500]
+        rows = conn.execute(
+            f"""SELECT permalink, file_key, extension, size, content_hash
+            FROM raw_manifest WHERE permalink IN ({", ".join("?" * len(batch))})""",
+            batch,
+        )
+        for permalink, file_key, extension, size, content_hash in rows:
+            raw_files[permalink] = {
+                "file_key": file_key,
+                "extension": extension,
+                "size": size,
+                "content_hash": content_hash,
+            }
+    conn.close()
+    return raw_files
+
+
+def save_content_hashes(hashes: Dict[str, str]):
+    """
+    Record content hashes computed after the fact, for files listed without one
+    """
+    if not hashes:
+        return
+    conn = connect()
+    with conn:
+        conn.executemany(
+            "UPDATE raw_manifest SET content_hash = ? WHERE permalink = ?",
+            [(content_hash, permalink) for permalink, content_hash in hashes.items()],
+        )
+    conn.close()
+
+
+def list_raw_files(s3_client, bucket: str, prefix: str = RAW_PREFIX) -> Dict[str, dict]:
+    """
+    List the raw pattern files in S3 with a paginated listing. When a pattern
+    has several raw files, the most recently modified one wins.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): the bucket
+        prefix (str): listed prefix, all raw files by default
+
+    Returns:
+        Dict[str, dict]: The S3 object of the raw file of every pattern, with
+        its extension, by permalink
+    """
+    latest = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            parts = obj["Key"][len(RAW_PREFIX) :].split("/")
+            if len(parts) != 2 or "." not in parts[1]:
+                continue
+            permalink, extension = parts[0], parts[1].rsplit(".", 1)[1]
+            if extension == "json":
+                continue
+            if (
+                permalink not in latest
+                or obj["LastModified"] > latest[permalink]["LastModified"]
+            ):
+                latest[permalink] = {**obj, "extension": extension}
+    return latest
+
+
+def save_listed_raw_files(conn, raw_files: Dict[str, dict]):
+    conn.executemany(
+        UPSERT_LISTED_RAW_FILE,
+        [
+            (
+                permalink,
+                obj["Key"],
+                obj["extension"],
+                obj["Size"],
+                obj["LastModified"].isoformat(timespec="seconds"),
+            )
+            for permalink, obj in raw_files.items()
+        ],
+    )
+
+
+def add_missing_raw_files(
+    s3_client,
+    bucket: str,
+    permalinks: List[str],
+    workers: int = 16,
+    recheck_after: timedelta = timedelta(days=7),
+) -> int:
+    """
+    Add patterns missing from the manifest, like patterns scraped before it
+    existed, by listing the raw files of just those patterns. Patterns that
+    are not found are recorded, and not listed again until recheck_after
+    has passed.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): the bucket
+        permalinks (List[str]): patterns missing from the manifest
+        workers (int): number of concurrent listings
+        recheck_after (timedelta): how long a pattern without a raw file is
+            not listed again
+
+    Returns:
+        int: The number of patterns that were found in S3 and added
+    """
+    conn = connect()
+    cutoff = (datetime.now() - recheck_after).isoformat(timespec="seconds")
+    recently_checked = set()
+    for i in range(0, len(permalinks), 500):
+        batch = permalinks[i : i + 500]
+        recently_checked.update(
+            row[0]
+            for row in conn.execute(
+                f"""SELECT permalink FROM raw_manifest_misses
+                WHERE checked_at > ? AND permalink IN ({", ".join("?" * len(batch))})""",
+                [cutoff, *batch],
+            )
+        )
+    to_list = [permalink for permalink in permalinks if permalink not in recently_checked]
+    if recently_checked:
+        print(f"Skipped {len(recently_checked)} patterns recently not found in S3")
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for raw_files in pool.map(
+            lambda permalink: list_raw_files(s3_client, bucket, f"{RAW_PREFIX}{permalink}/"),
+            to_list,
+        ):
+            found.update(raw_files)
+    checked_at = datetime.now().isoformat(timespec="seconds")
+    with conn:
+        save_listed_raw_files(conn, found)
+        conn.executemany(
+            """INSERT INTO raw_manifest_misses (permalink, checked_at) VALUES (?, ?)
+            ON CONFLICT(permalink) DO UPDATE SET checked_at = excluded.checked_at""",
+            [(permalink, checked_at) for permalink in to_list if permalink not in found],
+        )
+        conn.executemany(
+            "DELETE FROM raw_manifest_misses WHERE permalink = ?",
+            [(permalink,) for permalink in found],
+        )
+    conn.close()
+    return len(found)
+
+
+def rebuild_manifest(s3_client, bucket: str) -> int:
+    """
+    Rebuild the manifest from a listing of the raw files in S3. Patterns
+    without a raw file anymore are removed.
+
+    Returns:
+        int: The number of raw files in the manifest
+    """
+    latest = list_raw_files(s3_client, bucket)
+    conn = connect()
+    with conn:
+        save_listed_raw_files(conn, latest)
+        # Files that are no longer in the bucket
+        stale = [
+            (permalink,)
+            for (permalink,) in conn.execute("SELECT permalink FROM raw_manifest")
+            if permalink not in latest
+        ]
+        conn.executemany("DELETE FROM raw_manifest WHERE permalink = ?", stale)
+    conn.close()
+    print(f"Rebuilt raw file manifest with {len(latest)} files, removed {len(stale)}")
+    return len(latest)
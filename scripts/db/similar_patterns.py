@@ -0,0 +1,86 @@
+import json
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, List, Optional, Tuple
+from db.sqlite import connect
+
+# Rows written per transaction while the new table is filled
+SAVE_BATCH_SIZE = 1000
+
+
+def save_similar_patterns(rows: Iterable[Tuple[str, List[str], List[float]]]) -> int:
+    """
+    Replace the whole similar patterns table. The rows are written to a
+    staging table in short transactions, since computing them takes minutes,
+    and the staging table is swapped in at the end, so readers keep seeing
+    the previous neighbours until the new ones are complete.
+
+    Args:
+        rows: Point id of a pattern, point ids of its neighbours and their
+            cosine similarity, best first
+
+    Returns:
+        int: The number of patterns saved
+    """
+    updated_at = datetime.now().isoformat(timespec="seconds")
+    conn = connect()
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS similar_patterns_new")
+        conn.execute(
+            """CREATE TABLE similar_patterns_new (
+                pattern_id TEXT PRIMARY KEY,
+                neighbours TEXT,
+                updated_at TEXT
+            )"""
+        )
+    rows = iter(rows)
+    saved = 0
+    while True:
+        # Computed outside of the transaction, which only lasts for the insert
+        batch = [
+            (
+                pattern_id,
+                json.dumps(
+                    [[neighbour, round(score, 4)] for neighbour, score in zip(ids, scores)],
+                    separators=(",", ":"),
+                ),
+                updated_at,
+            )
+            for pattern_id, ids, scores in islice(rows, SAVE_BATCH_SIZE)
+        ]
+        if not batch:
+            break
+        with conn:
+            conn.executemany(
+                "INSERT INTO similar_patterns_new (pattern_id, neighbours, updated_at) VALUES (?, ?, ?)",
+                batch,
+            )
+        saved += len(batch)
+    with conn:
+        # sqlite3 does not open a transaction for DDL statements by itself
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DROP TABLE IF EXISTS similar_patterns")
+        conn.execute("ALTER TABLE similar_patterns_new RENAME TO similar_patterns")
+    conn.close()
+    return saved
+
+
+def fetch_similar_patterns(pattern_id: str, limit: Optional[int] = None) -> List[dict]:
+    """
+    Fetch the precomputed neighbours of a pattern.
+
+    Args:
+        pattern_id: Qdrant point id of the pattern, see generate_stable_uuid
+        limit: Number of neighbours to return, all of them by default
+
+    Returns:
+        List[dict]: id and score of every neighbour, best first
+    """
+    conn = connect()
+    row = conn.execute(
+        "SELECT neighbours FROM similar_patterns WHERE pattern_id = ?", (pattern_id,)
+    ).fetchone()
+    conn.close()
+    if row is None:
+        return []
+    return [{"id": neighbour, "score": score} for neighbour, score in json.loads(row[0])[:limit]]
@@ -1,9 +1,43 @@
 # Initialize database
 import sqlite3
 
+DB_PATH = "db/scraper.db"
+
+# HTTP validators of the pattern JSON and the pattern file, stored next to
+# the hash so that re-crawls can send conditional requests
+VALIDATOR_COLUMNS = {
+    "json_etag": "TEXT",
+    "json_last_modified": "TEXT",
+    "json_content_length": "INTEGER",
+    "file_url": "TEXT",
+    "file_etag": "TEXT",
+    "file_last_modified": "TEXT",
+    "file_content_length": "INTEGER",
+}
+
+
+def connect(db_path: str = DB_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Open a connection to the scraper database in WAL mode, so that readers
+    are not blocked while the scraper writes
+
+    Args:
+        db_path (str): path of the database file
+        check_same_thread (bool): False to share the connection between
+            threads, which must then serialize their use of it
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # 64MB
+    # Wait for the lock held by another writer instead of failing right away
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
 
 def init_db():
-    conn = sqlite3.connect("db/scraper.db")
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS scraped_patterns (
@@ -12,5 +46,71 @@ def init_db():
             last_checked TEXT
         )"""
     )
+
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS crawl_cursors (
+            category TEXT PRIMARY KEY,
+            last_page INTEGER,
+            total_pages INTEGER,
+            updated_at TEXT
+        )"""
+    )
+
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS seen_patterns (
+            id INTEGER PRIMARY KEY,
+            seen_at TEXT
+        )"""
+    )
+
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS extraction_cache (
+            content_hash TEXT,
+            extractor TEXT,
+            processed_key TEXT,
+            created_at TEXT,
+            PRIMARY KEY (content_hash, extractor)
+        )"""
+    )
+
+    # Raw file of every pattern, so stages can be planned without listing S3
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS raw_manifest (
+            permalink TEXT PRIMARY KEY,
+            file_key TEXT,
+            extension TEXT,
+            size INTEGER,
+            content_hash TEXT,
+            updated_at TEXT
+        )"""
+    )
+
+    # Patterns whose raw file was looked up in S3 and not found, so they are
+    # not listed again on every run
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS raw_manifest_misses (
+            permalink TEXT PRIMARY KEY,
+            checked_at TEXT
+        )"""
+    )
+
+    # Precomputed nearest neighbours of every pattern, by Qdrant point id
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS similar_patterns (
+            pattern_id TEXT PRIMARY KEY,
+            neighbours TEXT,
+            updated_at TEXT
+        )"""
+    )
+
+    # Add columns introduced after the table was first created
+    existing_columns = {
+        row[1] for row in cursor.execute("PRAGMA table_info(scraped_patterns)")
+    }
+    for column, column_type in VALIDATOR_COLUMNS.items():
+        if column not in existing_columns:
+            cursor.execute(
+                f"ALTER TABLE scraped_patterns ADD COLUMN {column} {column_type}"
+            )
     conn.commit()
     conn.close()
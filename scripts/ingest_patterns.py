@@ -1,15 +1,39 @@
+import asyncio
+import hashlib
 import os
+import sys
 import boto3
 import uuid
 import json
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 from models.pattern import Pattern
 from db.cache import fetch_latest_processed_patterns
-from utils.qdrant import init_qdrant, upsert_to_qdrant
+from db.manifest import list_raw_files
+from utils.qdrant import (
+    COLLECTION_NAME,
+    bump_collection_version,
+    delete_points,
+    fetch_point_hashes,
+    get_qdrant_client,
+    init_qdrant,
+    rebuild_collection,
+    QdrantUpsertWriter,
+)
+from utils.embedding_client import AsyncEmbeddingClient
 from utils.text_embedding_generator import EMBEDDING_GENERATOR
 
 load_dotenv()
 
+# Bump when the payload of the points changes, so every point is rewritten
+PAYLOAD_VERSION = "1"
+
+# Patterns loaded and embedded together, which bounds the memory of a run
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+# Largest share of the points a deletion run may remove, a larger one is
+# more likely a listing problem than removed patterns
+DELETE_MAX_FRACTION = float(os.getenv("DELETE_MAX_FRACTION", 0.05))
+
 s3_client = boto3.client(
     "s3",
     aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
@@ -17,29 +41,48 @@ s3_client = boto3.client(
     region_name=os.getenv("AWS_REGION"),
 )
 
-qdrant_client = init_qdrant()
-
 
 def generate_stable_uuid(string_input):
     return str(uuid.uuid5(uuid.NAMESPACE_URL, string_input))
 
 
-def ingest_patterns():
-    
-    patterns_to_process = fetch_latest_processed_patterns()
-    data_to_upsert = []
-    for permalink in patterns_to_process:
+def pattern_content_hash(metadata: bytes, text: str) -> str:
+    """
+    Hash of everything a point is built from: the pattern JSON, the pattern
+    text, the embedding settings and the payload layout
+    """
+    digest = hashlib.sha256(
+        f"{PAYLOAD_VERSION}:{EMBEDDING_GENERATOR.config_key}".encode("utf-8")
+    )
+    digest.update(b"\0" + metadata + b"\0" + text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+async def ingest_batch(
+    permalinks: List[str],
+    writer: QdrantUpsertWriter,
+    existing_hashes: Dict[str, Optional[str]],
+    embedding_client: AsyncEmbeddingClient,
+) -> int:
+    """
+    Load, embed and queue for upsert a batch of patterns.
+
+    Returns:
+        int: The number of patterns skipped because they did not change
+    """
+    metadata_by_permalink = {}
+    content_hashes = {}
+    texts = {}
+    unchanged = 0
+    for permalink in permalinks:
         try:
             file_key = f"processed/ravelry/{permalink}/{permalink}.txt"
             metadata_key = f"raw/ravelry/{permalink}/{permalink}.json"
 
-            metadata_dict = json.loads(
-                s3_client.get_object(Bucket=os.getenv("AWS_BUCKET_NAME"), Key=metadata_key)[
-                    "Body"
-                ]
-                .read()
-                .decode("utf-8")
-            )
+            metadata_bytes = s3_client.get_object(
+                Bucket=os.getenv("AWS_BUCKET_NAME"), Key=metadata_key
+            )["Body"].read()
+            metadata_dict = json.loads(metadata_bytes.decode("utf-8"))
 
             # Clean needle size
             if any(metadata_dict["gauge"]["pattern_needle_sizes"]):
@@ -53,39 +96,190 @@ def ingest_patterns():
 
             metadata = Pattern(**metadata_dict)
             print("filekey:", file_key)
-            pattern = (
+            text = (
                 s3_client.get_object(Bucket=os.getenv("AWS_BUCKET_NAME"), Key=file_key)[
                     "Body"
                 ]
                 .read()
                 .decode("utf-8")
             )
-            embedding = EMBEDDING_GENERATOR.get_document_embeddings(pattern)
-            data_to_upsert.append(
-                {
-                    "id": generate_stable_uuid(permalink),
-                    "metadata": {
-                        "craft": metadata.craft,
-                        "pattern_attributes": [attr.permalink.lower() for attr in metadata.pattern_attributes],
-                        "pattern_categories": [attr.permalink.lower() for attr in metadata.pattern_categories],
-                        "gauge": metadata.gauge,
-                        "ratings": metadata.ratings,
-                        "permalink": metadata.permalink,
-                        "yarn_weight": metadata.gauge.map_yarn_weight()
-                    },
-                    "embedding": embedding,
-                }
-            )
+            content_hash = pattern_content_hash(metadata_bytes, text)
+            if existing_hashes.get(generate_stable_uuid(permalink)) == content_hash:
+                unchanged += 1
+                continue
+            texts[permalink] = text
+            content_hashes[permalink] = content_hash
+            metadata_by_permalink[permalink] = metadata
         except Exception as e:
             print(f"Error processing {permalink}, {e}")
 
-    upsert_to_qdrant(qdrant_client, data_to_upsert)
-    return data_to_upsert
+    # Chunks from every pattern of the batch share requests, with as many
+    # requests in flight as the account rate limits allow
+    embeddings = await EMBEDDING_GENERATOR.get_document_embeddings_batch_async(
+        texts, client=embedding_client
+    )
+
+    for permalink, metadata in metadata_by_permalink.items():
+        embedding = embeddings.get(permalink)
+        if not embedding:
+            print(f"Error processing {permalink}, no embedding")
+            continue
+        writer.add(
+            {
+                "id": generate_stable_uuid(permalink),
+                "metadata": {
+                    "craft": metadata.craft,
+                    "pattern_attributes": [attr.permalink.lower() for attr in metadata.pattern_attributes],
+                    "pattern_categories": [attr.permalink.lower() for attr in metadata.pattern_categories],
+                    "gauge": metadata.gauge.model_dump(),
+                    "ratings": metadata.ratings.model_dump(),
+                    "permalink": metadata.permalink,
+                    "yarn_weight": metadata.gauge.map_yarn_weight(),
+                    # Flat copies of nested fields, for the payload indexes
+                    "needle_sizes_metric": [
+                        needle_size.metric
+                        for needle_size in metadata.gauge.pattern_needle_sizes or []
+                    ],
+                    "yardage": metadata.gauge.yardage,
+                    "yardage_max": metadata.gauge.yardage_max,
+                    "rating_average": metadata.ratings.rating_average,
+                },
+                "embedding": embedding,
+                "content_hash": content_hashes[permalink],
+            }
+        )
+    return unchanged
 
 
+def ingest_patterns(
+    permalinks: Optional[List[str]] = None,
+    collection_name: str = COLLECTION_NAME,
+    qdrant_client=None,
+    existing_hashes: Optional[Dict[str, Optional[str]]] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+    bump_version: bool = True,
+) -> int:
+    """
+    Embed patterns and stream them into Qdrant, `batch_size` patterns at a time.
+
+    Args:
+        permalinks: Patterns to ingest, the latest processed ones by default
+        collection_name: Collection to upsert into
+        qdrant_client: Qdrant client, a new one by default
+        existing_hashes: Content hash of the points already in the collection,
+            by point id. Patterns whose hash did not change are skipped.
+        batch_size: Number of patterns loaded and embedded together
+        bump_version: Bump the version of the collection if any point was
+            upserted. Off for a collection that is not searched yet
+
+    Returns:
+        int: The number of upserted patterns
+
+    Raises:
+        RuntimeError: If some points could not be upserted
+    """
+    if permalinks is None:
+        permalinks = fetch_latest_processed_patterns()
+    if qdrant_client is None:
+        qdrant_client = get_qdrant_client()
+    existing_hashes = existing_hashes or {}
+
+    async def ingest_all(writer: QdrantUpsertWriter) -> int:
+        # One client for the run, so the rate limits it learned carry over
+        # from one batch to the next
+        unchanged = 0
+        async with EMBEDDING_GENERATOR.async_client() as embedding_client:
+            for start in range(0, len(permalinks), batch_size):
+                unchanged += await ingest_batch(
+                    permalinks[start : start + batch_size],
+                    writer,
+                    existing_hashes,
+                    embedding_client,
+                )
+        return unchanged
+
+    writer = QdrantUpsertWriter(qdrant_client, collection_name)
+    try:
+        with writer:
+            unchanged = asyncio.run(ingest_all(writer))
+        print(f"Skipped {unchanged} unchanged patterns")
+    finally:
+        # Even a failed run may have changed some points
+        if bump_version and writer.upserted:
+            bump_collection_version(qdrant_client, collection_name)
+    return writer.upserted
+
+
+def delete_removed_patterns(
+    qdrant_client,
+    existing_hashes: Dict[str, Optional[str]],
+    max_fraction: float = DELETE_MAX_FRACTION,
+) -> int:
+    """
+    Delete the points of patterns whose raw file is no longer in S3. The raw
+    files are listed from S3 itself, not from the manifest, which may be
+    missing patterns.
+
+    Args:
+        qdrant_client: Qdrant client
+        existing_hashes: Content hash of the points in the collection, by point id
+        max_fraction: Nothing is deleted if more than this share of the
+            points would be
+
+    Returns:
+        int: The number of deleted points
+    """
+    permalinks = list_raw_files(s3_client, os.getenv("AWS_BUCKET_NAME"))
+    if not permalinks:
+        # An empty listing would delete everything
+        print("No raw files listed, not deleting any points")
+        return 0
+    current_ids = {generate_stable_uuid(permalink) for permalink in permalinks}
+    removed = [point_id for point_id in existing_hashes if point_id not in current_ids]
+    if len(removed) > max_fraction * len(existing_hashes):
+        print(
+            f"Refusing to delete {len(removed)} of {len(existing_hashes)} points, "
+            f"more than {max_fraction:.0%} of the collection"
+        )
+        return 0
+    delete_points(qdrant_client, removed)
+    if removed:
+        bump_collection_version(qdrant_client)
+    return len(removed)
+
+
+def rebuild_patterns():
+    """
+    Ingest every pattern with a raw file into a new collection and swap the
+    alias over to it once it is filled. The raw files are listed from S3,
+    since the manifest may be missing patterns.
+    """
+    permalinks = list(list_raw_files(s3_client, os.getenv("AWS_BUCKET_NAME")))
+    if not permalinks:
+        print("No raw files listed, not rebuilding")
+        return 0
+    qdrant_client = get_qdrant_client()
+    return rebuild_collection(
+        qdrant_client,
+        # rebuild_collection bumps the version of the alias after the swap
+        lambda collection_name: ingest_patterns(
+            permalinks, collection_name, qdrant_client, bump_version=False
+        ),
+    )
+
 
 if __name__ == "__main__":
-    init_qdrant()
-    patterns = ingest_patterns()
-    # print(patterns[0].get("embedding"))
-    print("Patterns ingested: ", len(patterns))
+    if "--rebuild" in sys.argv:
+        ingested = rebuild_patterns()
+    else:
+        qdrant_client = init_qdrant()
+        existing_hashes = fetch_point_hashes(qdrant_client)
+        ingested = ingest_patterns(
+            qdrant_client=qdrant_client, existing_hashes=existing_hashes
+        )
+        if "--delete-removed" in sys.argv:
+            print(
+                "Patterns deleted: ",
+                delete_removed_patterns(qdrant_client, existing_hashes),
+            )
+    print("Patterns ingested: ", ingested)
@@ -21,14 +21,14 @@ class Gauge(BaseModel):
         Cleans the yarn weight description and maps it to a weight class
 
         Returns:
-            Yarn Weight class
+            Name of the Yarn Weight class
         """
         yarn_weight = self.yarn_weight_description.lower()
         if "light fingering" in yarn_weight:
-            return YarnWeights.FINE
+            return YarnWeights.FINE.name
         
         if "super bulky" in yarn_weight:
-            return YarnWeights.SUPER_BULKY
+            return YarnWeights.SUPER_BULKY.name
         
         clean_yarn_weight = yarn_weight.split(" ")[0]
         return YarnWeights.get_group(clean_yarn_weight)
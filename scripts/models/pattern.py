@@ -1,6 +1,6 @@
 from typing import List, Optional
 from pydantic import BaseModel
-import requests
+import httpx
 from bs4 import BeautifulSoup
 import re
 from models.helpers.download_location import DownloadLocation
@@ -24,9 +24,12 @@ class Pattern(BaseModel):
     pattern_attributes: Optional[List[PatternAttribute]]
     pattern_categories: Optional[List[PatternCategories]]
 
-    def retrieve_pattern_url(self) -> tuple[str, str]:
+    async def retrieve_pattern_url(self, client: httpx.AsyncClient) -> tuple[str, str]:
         """
         Finds the pattern and returns the link to the file and the extension
+
+        Args:
+            client (httpx.AsyncClient): http client used to fetch the download page
         """
         if not self.download_location.is_from_ravelry():
             # First, do a check if the download link is already the file
@@ -34,7 +37,7 @@ class Pattern(BaseModel):
             if is_file:
                 return "pdf", self.download_location.url
             else:
-                link_response = requests.get(self.download_location.url, timeout=20)
+                link_response = await client.get(self.download_location.url)
                 soup = BeautifulSoup(link_response.text, "html.parser")
                 # Try to find a pdf file link
                 links = soup.find_all(
@@ -47,7 +50,7 @@ class Pattern(BaseModel):
                 else:
                     return "pdf", links[0].get("href")
         else:
-            response = requests.get(self.download_location.url, timeout=20)
+            response = await client.get(self.download_location.url)
             soup = BeautifulSoup(response.text, "html.parser")
             # print("soup:", soup)
             links = soup.find_all(
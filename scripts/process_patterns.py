@@ -1,12 +1,26 @@
 import os
-import json
+import sys
 import asyncio
 import boto3
+from typing import Dict, List
 from dotenv import load_dotenv
-import nest_asyncio
-from utils.extraction import process_pdfs_batch, process_html_file
-from db.cache import fetch_latest_processed_patterns
-nest_asyncio.apply()
+from utils.extraction import (
+    HTML_EXTRACTOR_KEY,
+    cache_extraction,
+    get_pdf_extractor,
+    process_html_files,
+    raw_file_hash,
+    reuse_cached_extraction,
+)
+from db.cache import ExtractionCache, fetch_latest_processed_patterns
+from db.sqlite import init_db
+from db.manifest import (
+    add_missing_raw_files,
+    fetch_raw_files,
+    manifest_is_empty,
+    rebuild_manifest,
+    save_content_hashes,
+)
 
 load_dotenv()
 
@@ -17,64 +31,179 @@ s3_client = boto3.client(
     region_name=os.getenv("AWS_REGION"),
 )
 
+# One of "llamaparse", "local" or "auto"
+PDF_EXTRACTOR = os.getenv("PDF_EXTRACTOR", "llamaparse")
+
+
+def filter_cached_extractions(
+    permalinks: List[str],
+    extension: str,
+    extractor_key: str,
+    file_hashes: Dict[str, str],
+    extraction_cache: ExtractionCache,
+) -> List[str]:
+    """
+    Reuse the cached extraction of every raw file that was already extracted
+
+    Args:
+        permalinks (List[str]): permalinks of the patterns
+        extension (str): extension of their raw files
+        extractor_key (str): name and version of the extractor
+        file_hashes (Dict[str, str]): content hashes of the raw files, by
+            permalink. Missing hashes are computed and added
+        extraction_cache (ExtractionCache): the extraction cache
+
+    Returns:
+        List[str]: The permalinks that still need to be extracted
+    """
+    to_extract = []
+    for permalink in permalinks:
+        try:
+            if permalink not in file_hashes:
+                file_hashes[permalink] = raw_file_hash(permalink, extension)
+        except Exception as e:
+            print(f"Error hashing raw file for {permalink}: {e}")
+            to_extract.append(permalink)
+            continue
+        if not reuse_cached_extraction(
+            extraction_cache, permalink, file_hashes[permalink], extractor_key
+        ):
+            to_extract.append(permalink)
+    return to_extract
+
+
+def cache_extractions(
+    permalinks: List[str],
+    extractor_key: str,
+    file_hashes: Dict[str, str],
+    extraction_cache: ExtractionCache,
+):
+    """
+    Record newly extracted texts in the extraction cache
+    """
+    for permalink in permalinks:
+        if permalink in file_hashes:
+            cache_extraction(
+                extraction_cache, permalink, file_hashes[permalink], extractor_key
+            )
+
 
-async def process_all_patterns():
+async def process_all_patterns(
+    pdf_extractor_name: str = PDF_EXTRACTOR, rebuild: bool = False
+):
     """
     Process all patterns in the S3 bucket, with async HTML processing
+
+    Args:
+        pdf_extractor_name (str): the PDF extractor to use, see get_pdf_extractor
+        rebuild (bool): rebuild the raw file manifest from an S3 listing first.
+            Always done when the manifest is empty
     """
-    # List all pattern folders
-    prefix = "raw/ravelry/"
+    # Creates the manifest and extraction cache tables on older databases
+    init_db()
+    if rebuild or manifest_is_empty():
+        rebuild_manifest(s3_client, os.getenv("AWS_BUCKET_NAME"))
 
    #TODO: Want to only process new patterns, not all of them
     # Get the latest processed patterns from the database
     latest_processed_patterns = fetch_latest_processed_patterns()
 
-    # Separate PDFs and HTMLs by permalink
-    pdf_permalinks = []
-    html_permalinks = []
-
-    for permalink in latest_processed_patterns:
-        # file_key = key.get("Key")
-        file_key = s3_client.list_objects_v2(Bucket=os.getenv("AWS_BUCKET_NAME"), Prefix=f"{prefix}{permalink}")
-        for obj in file_key.get("Contents", []):
-            extension = obj.get("Key").split(".")[-1]
-
-            if extension == "json":
-                continue
-            elif extension == "pdf":
-                pdf_permalinks.append(permalink)
-            elif extension == "html":
-                html_permalinks.append(permalink)
+    # Separate PDFs and HTMLs by permalink, using the raw file manifest
+    raw_files = fetch_raw_files(latest_processed_patterns)
+    missing = [p for p in latest_processed_patterns if p not in raw_files]
+    if missing:
+        added = add_missing_raw_files(s3_client, os.getenv("AWS_BUCKET_NAME"), missing)
+        print(
+            f"{len(missing)} patterns were missing from the raw file manifest, "
+            f"found {added} of them in S3"
+        )
+        raw_files.update(fetch_raw_files(missing))
+    pdf_permalinks = [
+        permalink
+        for permalink, raw_file in raw_files.items()
+        if raw_file["extension"] == "pdf"
+    ]
+    html_permalinks = [
+        permalink
+        for permalink, raw_file in raw_files.items()
+        if raw_file["extension"] == "html"
+    ]
 
     print(
         f"Found {len(pdf_permalinks)} PDFs and {len(html_permalinks)} HTMLs to process"
     )
 
-    # Process PDFs in batches (synchronously)
-    pdf_results = {}
-    total_pdfs = len(pdf_permalinks)
-    batch_size = min(25, max(5, total_pdfs // 10))
-    print(f"Processing {total_pdfs} PDFs in batches of {batch_size}")
-
-    for i in range(0, total_pdfs, batch_size):
-        batch = pdf_permalinks[i : min(i + batch_size, total_pdfs)]
-        if batch:
-            batch_results = process_pdfs_batch(batch)
-            pdf_results.update(batch_results)
-
-    # Process HTMLs asynchronously
-    html_tasks = [process_html_file(permalink) for permalink in html_permalinks]
-    html_results = await asyncio.gather(*html_tasks)
-
-    # Combine results
-    all_results = pdf_results.copy()
-    for permalink, content in html_results:
-        if content is not None:
-            all_results[permalink] = content
+    # Skip raw files that are identical to ones already extracted
+    pdf_extractor = get_pdf_extractor(pdf_extractor_name)
+    extraction_cache = ExtractionCache()
+    try:
+        file_hashes = {
+            permalink: raw_file["content_hash"]
+            for permalink, raw_file in raw_files.items()
+            if raw_file["content_hash"]
+        }
+        known_hashes = set(file_hashes)
+        found_patterns = len(pdf_permalinks) + len(html_permalinks)
+        pdf_permalinks = filter_cached_extractions(
+            pdf_permalinks, "pdf", pdf_extractor.cache_key, file_hashes, extraction_cache
+        )
+        html_permalinks = filter_cached_extractions(
+            html_permalinks, "html", HTML_EXTRACTOR_KEY, file_hashes, extraction_cache
+        )
+        save_content_hashes(
+            {
+                permalink: content_hash
+                for permalink, content_hash in file_hashes.items()
+                if permalink not in known_hashes
+            }
+        )
+        cached_patterns = found_patterns - len(pdf_permalinks) - len(html_permalinks)
+        print(f"Reused cached extractions for {cached_patterns} patterns")
+
+        # Process PDFs in batches. The extractors are synchronous, and LlamaParse
+        # runs its own event loop, so each batch runs in a worker thread
+        pdf_results = {}
+        total_pdfs = len(pdf_permalinks)
+        batch_size = min(25, max(5, total_pdfs // 10))
+        print(f"Processing {total_pdfs} PDFs in batches of {batch_size}")
+
+        try:
+            for i in range(0, total_pdfs, batch_size):
+                batch = pdf_permalinks[i : min(i + batch_size, total_pdfs)]
+                if batch:
+                    batch_results = await asyncio.to_thread(pdf_extractor.extract, batch)
+                    pdf_results.update(batch_results)
+                    cache_extractions(
+                        list(batch_results),
+                        pdf_extractor.cache_key,
+                        file_hashes,
+                        extraction_cache,
+                    )
+        finally:
+            pdf_extractor.close()
+
+        # Process HTMLs concurrently
+        html_results = await process_html_files(html_permalinks)
+
+        # Combine results
+        all_results = pdf_results.copy()
+        for permalink, content in html_results:
+            if content is not None:
+                all_results[permalink] = content
+        cache_extractions(
+            [permalink for permalink, content in html_results if content is not None],
+            HTML_EXTRACTOR_KEY,
+            file_hashes,
+            extraction_cache,
+        )
+    finally:
+        extraction_cache.close()
 
     print(f"Successfully processed {len(all_results)} patterns")
     return all_results
 
 
 if __name__ == "__main__":
-    patterns = asyncio.run(process_all_patterns())
+    patterns = asyncio.run(
+        process_all_patterns(rebuild="--rebuild-manifest" in sys.argv)
+    )
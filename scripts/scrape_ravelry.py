@@ -1,15 +1,28 @@
 import os
+import sys
 import httpx
 import asyncio
-from typing import List, Dict
+from datetime import timedelta
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 import boto3
 from dotenv import load_dotenv
 from urllib.parse import quote
-from utils.preprocess import preprocess_pattern, check_pattern_url_is_active
+from utils.preprocess import preprocess_pattern, check_pattern_content_is_active
 from models.pattern import Pattern
-from db.cache import compute_hash, data_has_changed, update_database
+from db.cache import compute_hash, ScrapedPatternStore
 from db.sqlite import init_db
-from utils.aws import save_json_to_s3, save_file_to_s3
+from db.crawl_state import CrawlCursors, SeenPatterns
+from utils.aws import save_json_to_s3, stream_file_to_s3
+from utils.rate_limiter import TokenBucket
 
 load_dotenv()
 
@@ -19,7 +32,43 @@ RAVELRY_AUTH = (
     os.getenv("RAVELRY_PERSONAL_USERNAME"),
     os.getenv("RAVLERY_PASSWORD_KEY"),
 )
-RATE_LIMIT = 5  # Max requests per second (adjust based on Ravelry's rate limits)
+RATE_LIMIT = float(
+    os.getenv("RAVELRY_RATE_LIMIT", 5)
+)  # Max requests per second (adjust based on Ravelry's rate limits)
+RATE_LIMIT_BURST = int(os.getenv("RAVELRY_RATE_LIMIT_BURST", 5))
+SCRAPE_WORKERS = int(os.getenv("RAVELRY_SCRAPE_WORKERS", 4))
+# Attempts at a search page before it is left for the next run
+PAGE_MAX_ATTEMPTS = int(os.getenv("RAVELRY_PAGE_MAX_ATTEMPTS", 3))
+# Saved patterns waiting for the consumer of fetch_all_patterns
+OUTPUT_QUEUE_SIZE = 500
+# Saved patterns between two progress lines of main
+SCRAPE_LOG_BATCH_SIZE = 100
+# Skip patterns seen by a previous run within this many hours, unset to only
+# deduplicate patterns within a run
+SEEN_PATTERNS_TTL_HOURS = os.getenv("RAVELRY_SEEN_PATTERNS_TTL_HOURS")
+DETAIL_CONCURRENCY = int(os.getenv("RAVELRY_DETAIL_CONCURRENCY", 10))
+# Fetch pattern details through the multi-id endpoint instead of one by one
+BULK_DETAILS = os.getenv("RAVELRY_BULK_DETAILS", "true").lower() == "true"
+BULK_DETAILS_SIZE = int(os.getenv("RAVELRY_BULK_DETAILS_SIZE", 50))
+# Revalidate already scraped patterns one by one with conditional requests
+# instead of fetching them in bulk
+REVALIDATE_DETAILS = os.getenv("RAVELRY_REVALIDATE_DETAILS", "true").lower() == "true"
+
+# Concurrency limits for each stage of saving a pattern
+RESOLVE_CONCURRENCY = int(os.getenv("SCRAPE_RESOLVE_CONCURRENCY", 10))
+DOWNLOAD_CONCURRENCY = int(os.getenv("SCRAPE_DOWNLOAD_CONCURRENCY", 10))
+UPLOAD_CONCURRENCY = int(os.getenv("SCRAPE_UPLOAD_CONCURRENCY", 10))
+HTTP_TIMEOUT = 20
+# Bytes of each file inspected for parked domain redirects before it is saved
+SNIFF_BYTES = 16 * 1024
+
+# Shared by every request made to the Ravelry API
+RAVELRY_LIMITER = TokenBucket(rate=RATE_LIMIT, burst=RATE_LIMIT_BURST)
+# Bounds the number of in-flight pattern detail requests across all workers
+DETAIL_SEMAPHORE = asyncio.Semaphore(DETAIL_CONCURRENCY)
+RESOLVE_SEMAPHORE = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+DOWNLOAD_SEMAPHORE = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+UPLOAD_SEMAPHORE = asyncio.Semaphore(UPLOAD_CONCURRENCY)
 
 S3_BUCKET = os.getenv("AWS_BUCKET_NAME")
 s3_client = boto3.client(
@@ -30,21 +79,313 @@ s3_client = boto3.client(
 )
 
 
-async def fetch_patterns(
-    client: httpx.AsyncClient, page: int, query: str
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Create the pooled http client shared by the Ravelry API calls and the
+    requests made to designer websites
+    """
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=DETAIL_CONCURRENCY
+            + RESOLVE_CONCURRENCY
+            + DOWNLOAD_CONCURRENCY,
+            max_keepalive_connections=DETAIL_CONCURRENCY + DOWNLOAD_CONCURRENCY,
+        ),
+    )
+
+
+def conditional_headers(validators: Dict) -> Dict:
+    """
+    Build the headers of a conditional request from stored validators
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(response: httpx.Response) -> Dict:
+    """
+    Read the validators to store from a response
+    """
+    content_length = response.headers.get("content-length")
+    return {
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "content_length": int(content_length) if content_length else None,
+    }
+
+
+async def ravelry_get(
+    client: httpx.AsyncClient, path: str, params: Dict = None, headers: Dict = None
+) -> httpx.Response:
+    """
+    Make a rate limited GET request to the Ravelry API
+
+    Args:
+        client (httpx.AsyncClient): http client to send the request with
+        path (str): API path, relative to RAVELRY_API_URL
+        params (dict): query parameters
+        headers (dict): extra request headers
+
+    Returns:
+        httpx.Response: The API response
+    """
+    await RAVELRY_LIMITER.acquire()
+    return await client.get(
+        RAVELRY_API_URL + path, auth=RAVELRY_AUTH, params=params, headers=headers
+    )
+
+
+async def fetch_pattern_detail(
+    client: httpx.AsyncClient, pattern_id: int, validators: Dict = None
+) -> Optional[Tuple[Dict, Dict]]:
+    """
+    Fetch the full details of a single pattern
+
+    Args:
+        client (httpx.AsyncClient): http client to send the request with
+        pattern_id (int): Ravelry id of the pattern
+        validators (dict): validators of the last fetch, to make the request conditional
+
+    Returns:
+        Tuple[dict, dict]: The pattern details and the validators of the
+        response, or None if the pattern has not been modified
+    """
+    async with DETAIL_SEMAPHORE:
+        response = await ravelry_get(
+            client,
+            f"/patterns/{pattern_id}.json",
+            headers=conditional_headers(validators or {}),
+        )
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return response.json()["pattern"], response_validators(response)
+
+
+async def fetch_pattern_details_bulk(
+    client: httpx.AsyncClient, pattern_ids: List[int]
 ) -> List[Dict]:
+    """
+    Fetch the details of several patterns in a single request
+
+    Args:
+        client (httpx.AsyncClient): http client to send the request with
+        pattern_ids (List[int]): Ravelry ids of the patterns
+
+    Returns:
+        List[dict]: The pattern details, in the same order as pattern_ids.
+        Patterns missing from the response are left out.
+    """
+    async with DETAIL_SEMAPHORE:
+        response = await ravelry_get(
+            client,
+            "/patterns.json",
+            params={"ids": " ".join(str(pattern_id) for pattern_id in pattern_ids)},
+        )
+    response.raise_for_status()
+
+    # The multi-id endpoint returns the patterns keyed by their id
+    json_patterns = response.json()["patterns"]
+    if isinstance(json_patterns, list):
+        json_patterns = {str(pattern["id"]): pattern for pattern in json_patterns}
+
+    return [
+        json_patterns[str(pattern_id)]
+        for pattern_id in pattern_ids
+        if str(pattern_id) in json_patterns
+    ]
+
+
+async def fetch_pattern_details(
+    client: httpx.AsyncClient,
+    pattern_ids: List[int],
+    bulk: bool = BULK_DETAILS,
+    validators: Dict[int, Dict] = None,
+) -> Tuple[List[Tuple[Dict, Dict]], List[int]]:
+    """
+    Fetch the details of a list of patterns concurrently.
+
+    Patterns with stored validators are fetched one by one with conditional
+    requests, since the multi-id endpoint cannot be revalidated per pattern,
+    and are left out when they have not been modified. The patterns of a
+    bulk request that fails, or that are missing from its response, are
+    fetched again one by one.
+
+    Args:
+        client (httpx.AsyncClient): http client to send the requests with
+        pattern_ids (List[int]): Ravelry ids of the patterns
+        bulk (bool): Use the multi-id endpoint, BULK_DETAILS_SIZE ids per request
+        validators (Dict[int, dict]): stored validators of the patterns to
+            revalidate, by pattern id
+
+    Returns:
+        Tuple[List[Tuple[dict, dict]], List[int]]: The pattern details with
+        the validators of their response, and the ids that could not be
+        fetched. Validators are empty for bulk requests.
+    """
+    validators = validators or {}
+    # Ids fetched by every request, and whether it is a bulk request
+    requests = [
+        (
+            [pattern_id],
+            False,
+            fetch_pattern_detail(client, pattern_id, validators[pattern_id]),
+        )
+        for pattern_id in pattern_ids
+        if validators.get(pattern_id)
+    ]
+    pattern_ids = [
+        pattern_id for pattern_id in pattern_ids if not validators.get(pattern_id)
+    ]
+    if bulk:
+        for i in range(0, len(pattern_ids), BULK_DETAILS_SIZE):
+            batch = pattern_ids[i : i + BULK_DETAILS_SIZE]
+            requests.append((batch, True, fetch_pattern_details_bulk(client, batch)))
+    else:
+        requests += [
+            ([pattern_id], False, fetch_pattern_detail(client, pattern_id))
+            for pattern_id in pattern_ids
+        ]
+
+    details = []
+    failed_ids = []
+    fallback_ids = []
+    results = await asyncio.gather(
+        *(request for _, _, request in requests), return_exceptions=True
+    )
+    for (ids, is_bulk, _), result in zip(requests, results):
+        if isinstance(result, Exception):
+            print(f"Error fetching details of {len(ids)} patterns: {result}")
+            (fallback_ids if is_bulk else failed_ids).extend(ids)
+        elif is_bulk:
+            details.extend((pattern_json, {}) for pattern_json in result)
+            found = {str(pattern_json["id"]) for pattern_json in result}
+            fallback_ids.extend(
+                pattern_id for pattern_id in ids if str(pattern_id) not in found
+            )
+        elif result is not None:
+            details.append(result)
+
+    if fallback_ids:
+        print(f"Fetching {len(fallback_ids)} patterns one by one")
+        fallback_details, fallback_failed_ids = await fetch_pattern_details(
+            client, fallback_ids, bulk=False
+        )
+        details += fallback_details
+        failed_ids += fallback_failed_ids
+    return details, failed_ids
+
+
+async def process_pattern(
+    client: httpx.AsyncClient,
+    pattern_json: Dict,
+    store: ScrapedPatternStore,
+    json_validators: Dict = None,
+) -> Optional[Pattern]:
+    """
+    Clean a pattern and save it with its file to S3, if it is a free english
+    pattern that changed since it was last scraped.
+
+    The file url is resolved, then the file is fetched once and streamed to
+    S3, after its first SNIFF_BYTES are checked for a parked domain redirect.
+    The file is requested conditionally, and only the metadata is saved when
+    it has not been modified. Each stage is bounded by its own semaphore.
+    The hash of the pattern is only recorded once it is saved, so a pattern
+    whose download or upload fails is scraped again.
+
+    Returns:
+        Pattern: The cleaned pattern, or None if it was skipped
+    """
+    available_languages = [language["code"] for language in pattern_json["languages"]]
+    if not (pattern_json["free"] and "en" in available_languages):
+        return None
+
+    permalink = pattern_json["permalink"]
+    pattern_hash = compute_hash(pattern_json)
+    if not store.data_has_changed(permalink, pattern_hash, pattern_json):
+        if json_validators:
+            store.update_validators(permalink, "json", json_validators)
+        return None
+
+    def mark_scraped():
+        # Only once the pattern is saved, so a failed pattern is retried
+        store.update(permalink, pattern_hash)
+        if json_validators:
+            store.update_validators(permalink, "json", json_validators)
+
+    cleaned_pattern = Pattern(**preprocess_pattern(pattern_json))
+    async with RESOLVE_SEMAPHORE:
+        extension, file_url = await cleaned_pattern.retrieve_pattern_url(client)
+
+    file_validators = store.get_validators(permalink, "file", url=file_url)
+    async with DOWNLOAD_SEMAPHORE:
+        async with client.stream(
+            "GET", file_url, headers=conditional_headers(file_validators)
+        ) as file_response:
+            if file_response.status_code == 304:
+                # The file is already in S3, only the metadata changed
+                async with UPLOAD_SEMAPHORE:
+                    await save_json_to_s3(cleaned_pattern.model_dump(), permalink)
+                mark_scraped()
+                return cleaned_pattern
+
+            file_response.raise_for_status()
+            chunks = file_response.aiter_bytes()
+            head = b""
+            async for chunk in chunks:
+                head += chunk
+                if len(head) >= SNIFF_BYTES:
+                    break
+            if not check_pattern_content_is_active(
+                head[:SNIFF_BYTES].decode("utf-8", errors="ignore")
+            ):
+                # Checked again only once the pattern changes
+                mark_scraped()
+                return None
+
+            async with UPLOAD_SEMAPHORE:
+                await save_json_to_s3(cleaned_pattern.model_dump(), permalink)
+            file_info = await stream_file_to_s3(chunks, extension, permalink, head=head)
+            store.record_raw_file(
+                permalink, extension, file_info["size"], file_info["sha256"]
+            )
+            store.update_validators(
+                permalink, "file", response_validators(file_response), url=file_url
+            )
+            mark_scraped()
+    return cleaned_pattern
+
+
+async def fetch_patterns(
+    client: httpx.AsyncClient,
+    page: int,
+    query: str,
+    store: ScrapedPatternStore,
+    seen: SeenPatterns,
+) -> Tuple[List[Pattern], Optional[int], bool]:
     """
     Fetch a page of patterns from Ravelry's API for a specific category.
     In the first iteration, we will only fetch free patterns that are written in english.
+    Patterns already seen in another category or page are skipped.
+
+    Returns:
+        Tuple[List[Pattern], int, bool]: The saved patterns, the number of
+        pages reported by the search paginator, or None if the page could not
+        be fetched, and whether every pattern of the page was handled
     """
-    patterns_url = RAVELRY_API_URL + "/patterns/search.json"
     patterns = []
     try:
 
         # Get patterns from Ravelry
-        response = await client.get(
-            patterns_url,
-            auth=RAVELRY_AUTH,
+        response = await ravelry_get(
+            client,
+            "/patterns/search.json",
             params={
                 "query": query,
                 "page": page,
@@ -52,90 +393,273 @@ async def fetch_patterns(
             },
         )
         response.raise_for_status()  # Raise an exception for HTTP errors
-        json_patterns = response.json()["patterns"]
+        search_results = response.json()
+        page_count = search_results["paginator"]["page_count"]
+        new_pattern_ids = set(
+            seen.filter_new([pattern["id"] for pattern in search_results["patterns"]])
+        )
+        json_patterns = [
+            pattern
+            for pattern in search_results["patterns"]
+            if pattern["id"] in new_pattern_ids
+        ]
 
-        # Search for each pattern
-        for pattern in json_patterns:
-            pattern_response = await client.get(
-                RAVELRY_API_URL + f"/patterns/{pattern['id']}.json", auth=RAVELRY_AUTH
-            )
-            pattern_response.raise_for_status()
-            pattern_json = pattern_response.json()["pattern"]
-            print(pattern_json)
-            available_languages = [
-                language["code"] for language in pattern_json["languages"]
-            ]
-
-            if pattern_json["free"] and "en" in available_languages:
-                try:
-                    pattern_hash = compute_hash(pattern_json)
-                    if data_has_changed(pattern_json["permalink"], pattern_hash):
-                        cleaned_pattern = Pattern(**preprocess_pattern(pattern_json))
-                        extension, file_url = cleaned_pattern.retrieve_pattern_url()
-                        update_database(
-                            cleaned_pattern.permalink, pattern_hash
-                        )  # Update the database so that we won't scrape the same pattern again
-                        if check_pattern_url_is_active(file_url):
-                            save_json_to_s3(
-                                cleaned_pattern.model_dump(), cleaned_pattern.permalink
-                            )
-                            save_file_to_s3(
-                                file_url, extension, cleaned_pattern.permalink
-                            )
-                            patterns.append(cleaned_pattern)
-                except Exception as e:
-                    print(f"Error processing pattern {pattern_json['permalink']}: {e}")
-
-        return patterns
+        # Fetch the details of every pattern on the page that was modified
+        # Only patterns with stored validators are revalidated one by one,
+        # the others are fetched in bulk
+        validators = {}
+        if REVALIDATE_DETAILS:
+            for pattern in json_patterns:
+                pattern_validators = store.get_validators(pattern["permalink"], "json")
+                if pattern_validators:
+                    validators[pattern["id"]] = pattern_validators
+        pattern_details, failed_ids = await fetch_pattern_details(
+            client,
+            [pattern["id"] for pattern in json_patterns],
+            validators=validators,
+        )
+        results = await asyncio.gather(
+            *(
+                process_pattern(client, pattern_json, store, json_validators)
+                for pattern_json, json_validators in pattern_details
+            ),
+            return_exceptions=True,
+        )
+        # Only patterns whose details were fetched and processed are skipped
+        # by later runs
+        handled_ids = []
+        for (pattern_json, _), result in zip(pattern_details, results):
+            if isinstance(result, Exception):
+                print(f"Error processing pattern {pattern_json['permalink']}: {result}")
+                failed_ids.append(pattern_json["id"])
+                continue
+            handled_ids.append(pattern_json["id"])
+            if result is not None:
+                patterns.append(result)
+        seen.persist(handled_ids)
+        if failed_ids:
+            # The page is retried, and fetches them again
+            seen.forget(failed_ids)
+            print(f"{len(failed_ids)} patterns failed on page {page} for category {query}")
+
+        return patterns, page_count, not failed_ids
 
     except httpx.HTTPStatusError as e:
         print(f"Error fetching page {page} for category {query}: {e}")
-        return []
+        return [], None, False
 
 
-async def fetch_all_patterns(max_pages: int) -> List[Dict]:
+async def crawl_patterns(
+    store: ScrapedPatternStore,
+    cursors: CrawlCursors,
+    seen: SeenPatterns,
+    on_patterns: Callable[[List[Pattern]], Awaitable[None]],
+    max_pages: Optional[int] = None,
+):
     """
-    Fetch all patterns from Ravelry's API with rate limiting.
+    Crawl every category from Ravelry's API with rate limiting.
     Reads categories from to_scrape.txt and fetches patterns for each category.
-    """
-    patterns = []
 
+    Pages are fed through a queue to a pool of workers, so a slow page only
+    holds up its own worker. The request rate itself is enforced by
+    RAVELRY_LIMITER on every API call.
+
+    Each category resumes from its crawl cursor. The first page fetched for a
+    category reports the number of pages, and the remaining pages are then
+    queued. A page that fails, or on which a pattern fails, is queued again,
+    up to PAGE_MAX_ATTEMPTS times. Its cursor does not move past it until
+    then, so a page still failing is retried by the next run.
+
+    Args:
+        store (ScrapedPatternStore): hashes of the scraped patterns
+        cursors (CrawlCursors): crawl progress of every category
+        seen (SeenPatterns): pattern ids already handled
+        on_patterns (Callable): awaited with the saved patterns of every page
+        max_pages (int): last page to fetch in each category, all pages if None
+    """
     # Read categories from to_scrape.txt
     with open("to_scrape_trunc.txt", "r", encoding="utf-8") as f:
         categories = [line.strip() for line in f if line.strip()]
 
-    async with httpx.AsyncClient() as client:
-        for category in categories:
-            category = quote(category)
-            print(f"Fetching patterns for category: {category}")
-            tasks = []
-            for page in range(1, max_pages + 1):
-                tasks.append(fetch_patterns(client, page, category))
-                if len(tasks) >= RATE_LIMIT:
-                    # Wait for the current batch of tasks to complete
-                    results = await asyncio.gather(*tasks)
-                    patterns.extend([p for result in results for p in result])
-                    tasks = []
-                    await asyncio.sleep(2)  # Respect rate limits
+    pages = asyncio.Queue()
+    for category in categories:
+        start_page = cursors.next_page(category)
+        if start_page is None:
+            print(f"Skipping recently crawled category: {category}")
+            continue
+        # The first page of the run also discovers the number of pages
+        pages.put_nowait((category, start_page, True, 1))
+
+    def retry(category: str, page: int, is_first_page: bool, attempt: int):
+        # Queued before task_done, so the crawl does not end in between
+        if attempt < PAGE_MAX_ATTEMPTS:
+            pages.put_nowait((category, page, is_first_page, attempt + 1))
+        else:
+            print(f"Giving up on page {page} for category {category}")
+
+    async def worker(client: httpx.AsyncClient):
+        while True:
+            category, page, is_first_page, attempt = await pages.get()
+            print(f"Fetching page {page} of patterns for category: {category}")
+            try:
+                page_patterns, page_count, complete = await fetch_patterns(
+                    client, page, quote(category), store, seen
+                )
+                if page_count is None:
+                    retry(category, page, is_first_page, attempt)
+                    continue
+                await on_patterns(page_patterns)
+                last_page = (
+                    page_count if max_pages is None else min(page_count, max_pages)
+                )
+                if is_first_page:
+                    for next_page in range(page + 1, last_page + 1):
+                        pages.put_nowait((category, next_page, False, 1))
+                if not complete:
+                    # The cursor stays before the page until all of its
+                    # patterns were handled
+                    retry(category, page, False, attempt)
+                    continue
+                # The hashes of the page are committed before the cursor moves
+                # past it, so a crash cannot skip patterns that were not saved
+                store.flush()
+                cursors.page_done(category, page, page_count)
+            except Exception as e:
+                print(f"Error fetching page {page} for category {category}: {e}")
+                retry(category, page, is_first_page, attempt)
+            finally:
+                pages.task_done()
+
+    async with create_http_client() as client:
+        workers = [
+            asyncio.create_task(worker(client)) for _ in range(SCRAPE_WORKERS)
+        ]
+        try:
+            await pages.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def fetch_all_patterns(
+    store: ScrapedPatternStore,
+    cursors: CrawlCursors,
+    seen: SeenPatterns,
+    max_pages: Optional[int] = None,
+    batch_size: Optional[int] = None,
+) -> AsyncIterator[Union[Pattern, List[Pattern]]]:
+    """
+    Fetch all patterns from Ravelry's API, yielding them as they are saved.
+
+    Patterns wait in a queue of at most OUTPUT_QUEUE_SIZE patterns, so a slow
+    consumer pauses the crawl instead of letting patterns pile up in memory.
+    Closing the generator early stops the crawl.
+
+    Args:
+        store (ScrapedPatternStore): hashes of the scraped patterns
+        cursors (CrawlCursors): crawl progress of every category
+        seen (SeenPatterns): pattern ids already handled
+        max_pages (int): last page to fetch in each category, all pages if None
+        batch_size (int): yield lists of up to batch_size patterns instead of
+            single patterns
+
+    Yields:
+        Pattern, or List[Pattern] when batch_size is set
+    """
+    results = asyncio.Queue(maxsize=OUTPUT_QUEUE_SIZE)
+
+    async def on_patterns(page_patterns: List[Pattern]):
+        for pattern in page_patterns:
+            await results.put(pattern)
+
+    async def crawl():
+        try:
+            await crawl_patterns(store, cursors, seen, on_patterns, max_pages)
+        except Exception as e:
+            await results.put(e)
+        else:
+            await results.put(None)
+
+    crawl_task = asyncio.create_task(crawl())
+    batch = []
+    try:
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            if isinstance(result, Exception):
+                raise result
+            if batch_size is None:
+                yield result
+                continue
+            batch.append(result)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        if not crawl_task.done():
+            crawl_task.cancel()
+            await asyncio.gather(crawl_task, return_exceptions=True)
+
+
+async def scrape_summary(
+    store: ScrapedPatternStore,
+    cursors: CrawlCursors,
+    seen: SeenPatterns,
+    max_pages: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Crawl all patterns without keeping any of them, only counting them
+
+    Returns:
+        Dict[str, int]: The number of pages crawled and patterns saved
+    """
+    summary = {"pages": 0, "patterns": 0}
 
-            # Fetch any remaining tasks for this category
-            if tasks:
-                results = await asyncio.gather(*tasks)
-                patterns.extend([p for result in results for p in result])
+    async def on_patterns(page_patterns: List[Pattern]):
+        summary["pages"] += 1
+        summary["patterns"] += len(page_patterns)
 
-    return patterns
+    await crawl_patterns(store, cursors, seen, on_patterns, max_pages)
+    return summary
 
 
-async def main():
+async def main(summary_only: bool = False):
     """
     Main function to scrape Ravelry and save data.
+
+    Args:
+        summary_only (bool): only count the saved patterns, without keeping
+            any of them
     """
     init_db()
-    max_pages = 2  # Adjust based on how many pages you want to fetch
-    patterns = await fetch_all_patterns(max_pages)
+    seen_ttl = (
+        timedelta(hours=float(SEEN_PATTERNS_TTL_HOURS))
+        if SEEN_PATTERNS_TTL_HOURS
+        else None
+    )
+    with ScrapedPatternStore() as store, CrawlCursors() as cursors, SeenPatterns(
+        ttl=seen_ttl
+    ) as seen:
+        if summary_only:
+            summary = await scrape_summary(store, cursors, seen)
+            print(
+                f"Fetched {summary['patterns']} patterns from {summary['pages']} pages."
+            )
+            return
+
+        saved = 0
+        async for batch in fetch_all_patterns(
+            store, cursors, seen, batch_size=SCRAPE_LOG_BATCH_SIZE
+        ):
+            saved += len(batch)
+            print(f"Saved {saved} patterns, last: {batch[-1].permalink}")
 
-    print(f"Fetched {len(patterns)} patterns.")
+    print(f"Fetched {saved} patterns.")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(summary_only="--summary-only" in sys.argv))
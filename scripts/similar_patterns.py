@@ -0,0 +1,204 @@
+import argparse
+import os
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from qdrant_client import QdrantClient
+from db.similar_patterns import save_similar_patterns
+from db.sqlite import init_db
+from utils.qdrant import COLLECTION_NAME, get_qdrant_client
+
+# Neighbours kept for every pattern
+SIMILAR_PATTERNS_TOP_K = int(os.getenv("SIMILAR_PATTERNS_TOP_K", 20))
+# Patterns scored together, a block holds block_size * group size float32 scores
+SIMILAR_PATTERNS_BLOCK_SIZE = int(os.getenv("SIMILAR_PATTERNS_BLOCK_SIZE", 512))
+
+
+def load_vectors(
+    qdrant_client: QdrantClient, collection_name: str = COLLECTION_NAME, batch_size: int = 1000
+) -> Tuple[List[str], np.ndarray, List[Optional[str]], List[List[str]]]:
+    """
+    Scroll through the collection with vectors.
+
+    Returns:
+        Point ids, unit-normalized float32 vectors, craft and categories of every pattern
+    """
+    ids, pages, crafts, categories = [], [], [], []
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["craft", "pattern_categories"],
+            with_vectors=True,
+        )
+        if points:
+            pages.append(np.asarray([point.vector for point in points], dtype=np.float32))
+        for point in points:
+            payload = point.payload or {}
+            ids.append(str(point.id))
+            crafts.append(payload.get("craft"))
+            categories.append(payload.get("pattern_categories") or [])
+        if offset is None:
+            break
+    if not pages:
+        return ids, np.empty((0, 0), dtype=np.float32), crafts, categories
+    vectors = np.concatenate(pages)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms == 0, 1, norms)
+    return ids, vectors, crafts, categories
+
+
+def category_matrix(categories: List[List[str]]) -> np.ndarray:
+    """
+    One-hot matrix of the categories of every pattern, so that the number of
+    categories two blocks of patterns share is a matrix product
+    """
+    index = {}
+    for pattern_categories in categories:
+        for category in pattern_categories:
+            index.setdefault(category, len(index))
+    matrix = np.zeros((len(categories), len(index)), dtype=np.float32)
+    for row, pattern_categories in enumerate(categories):
+        matrix[row, [index[category] for category in pattern_categories]] = 1
+    return matrix
+
+
+def top_k_neighbours(
+    vectors: np.ndarray,
+    k: int = SIMILAR_PATTERNS_TOP_K,
+    categories: Optional[np.ndarray] = None,
+    block_size: int = SIMILAR_PATTERNS_BLOCK_SIZE,
+) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """
+    Exact top-k cosine neighbours of every vector, scored `block_size` rows at
+    a time so memory stays at `block_size * len(vectors)` scores.
+
+    Args:
+        vectors: Unit-normalized float32 vectors
+        k: Number of neighbours per vector
+        categories: Category matrix from `category_matrix`, if set only
+            patterns sharing a category are neighbours
+        block_size: Number of rows scored by one matrix product
+
+    Yields:
+        Row, indices and scores of its neighbours, best first
+    """
+    count = len(vectors)
+    k = min(k, count - 1)
+    if k <= 0:
+        return
+    for start in range(0, count, block_size):
+        block = vectors[start : start + block_size]
+        rows = np.arange(len(block))
+        scores = block @ vectors.T
+        # A pattern is not its own neighbour
+        scores[rows, start + rows] = -np.inf
+        if categories is not None:
+            shared = categories[start : start + block_size] @ categories.T
+            scores[shared == 0] = -np.inf
+        # Unordered top k of every row, then sort only those
+        candidates = np.argpartition(scores, -k, axis=1)[:, -k:]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        for row in rows:
+            # Rows with fewer than k allowed neighbours end with -inf
+            found = np.isfinite(candidate_scores[row])
+            yield start + row, candidates[row][found], candidate_scores[row][found]
+
+
+def similar_patterns(
+    ids: List[str],
+    vectors: np.ndarray,
+    crafts: List[Optional[str]],
+    categories: List[List[str]],
+    k: int = SIMILAR_PATTERNS_TOP_K,
+    same_category: bool = False,
+    block_size: int = SIMILAR_PATTERNS_BLOCK_SIZE,
+) -> Iterator[Tuple[str, List[str], List[float]]]:
+    """
+    Neighbours of every pattern among the patterns of the same craft, and
+    sharing a category if `same_category` is set.
+
+    Yields:
+        Point id of a pattern, point ids of its neighbours and their scores
+    """
+    groups: Dict[Optional[str], List[int]] = defaultdict(list)
+    for i, craft in enumerate(crafts):
+        groups[craft].append(i)
+    for craft, members in groups.items():
+        print(f"Scoring {len(members)} {craft or 'uncrafted'} patterns")
+        members = np.asarray(members)
+        group_categories = (
+            category_matrix([categories[i] for i in members]) if same_category else None
+        )
+        for row, neighbours, scores in top_k_neighbours(
+            vectors[members], k, group_categories, block_size
+        ):
+            yield (
+                ids[members[row]],
+                [ids[i] for i in members[neighbours]],
+                scores.tolist(),
+            )
+
+
+def build_similar_patterns(
+    collection_name: str = COLLECTION_NAME,
+    qdrant_client: Optional[QdrantClient] = None,
+    k: int = SIMILAR_PATTERNS_TOP_K,
+    same_category: bool = False,
+    block_size: int = SIMILAR_PATTERNS_BLOCK_SIZE,
+) -> int:
+    """
+    Recompute the similar patterns table from the vectors in Qdrant.
+
+    Args:
+        collection_name: Collection to read the vectors from
+        qdrant_client: Qdrant client, a new one by default
+        k: Number of neighbours kept per pattern
+        same_category: Only keep neighbours sharing a category
+        block_size: Number of patterns scored by one matrix product
+
+    Returns:
+        int: The number of patterns saved
+    """
+    qdrant_client = qdrant_client or get_qdrant_client()
+    ids, vectors, crafts, categories = load_vectors(qdrant_client, collection_name)
+    print(f"Loaded {len(ids)} vectors")
+    if not ids:
+        # An empty collection would empty the table
+        print("No vectors found, keeping the current similar patterns")
+        return 0
+    init_db()
+    return save_similar_patterns(
+        similar_patterns(ids, vectors, crafts, categories, k, same_category, block_size)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute the nearest neighbours of every pattern"
+    )
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--top-k", type=int, default=SIMILAR_PATTERNS_TOP_K)
+    parser.add_argument("--block-size", type=int, default=SIMILAR_PATTERNS_BLOCK_SIZE)
+    parser.add_argument(
+        "--same-category",
+        action="store_true",
+        help="Only keep neighbours sharing a category, on top of the same craft",
+    )
+    args = parser.parse_args()
+    saved = build_similar_patterns(
+        args.collection,
+        k=args.top_k,
+        same_category=args.same_category,
+        block_size=args.block_size,
+    )
+    print("Similar patterns saved: ", saved)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import asyncio
+import httpx
+import pytest
+import scrape_ravelry
+from utils.rate_limiter import TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def ravelry_api(monkeypatch):
+    monkeypatch.setattr(scrape_ravelry, "RAVELRY_API_URL", "https://ravelry.test")
+    monkeypatch.setattr(scrape_ravelry, "RAVELRY_AUTH", ("user", "key"))
+    monkeypatch.setattr(
+        scrape_ravelry, "RAVELRY_LIMITER", TokenBucket(rate=1000, burst=1000)
+    )
+    monkeypatch.setattr(scrape_ravelry, "BULK_DETAILS_SIZE", 2)
+
+
+def pattern(pattern_id: int) -> dict:
+    return {"id": pattern_id, "permalink": f"pattern-{pattern_id}"}
+
+
+def mock_ravelry(requests: list, failing_bulk=(), missing=()):
+    """
+    Stand-in for the pattern endpoints. Bulk requests containing an id of
+    failing_bulk fail, and ids in missing are not found.
+    """
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path == "/patterns.json":
+            ids = [int(pattern_id) for pattern_id in request.url.params["ids"].split()]
+            if set(ids) & set(failing_bulk):
+                return httpx.Response(500)
+            return httpx.Response(
+                200,
+                json={
+                    "patterns": {
+                        str(pattern_id): pattern(pattern_id)
+                        for pattern_id in ids
+                        if pattern_id not in missing
+                    }
+                },
+            )
+        pattern_id = int(request.url.path.rsplit("/", 1)[1].removesuffix(".json"))
+        if pattern_id in missing:
+            return httpx.Response(404)
+        return httpx.Response(
+            200, json={"pattern": pattern(pattern_id)}, headers={"etag": f'"{pattern_id}"'}
+        )
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+
+async def fetch_details(client: httpx.AsyncClient, pattern_ids, **kwargs):
+    async with client:
+        return await scrape_ravelry.fetch_pattern_details(client, pattern_ids, **kwargs)
+
+
+def test_bulk_requests_are_split_and_mapped_back_to_patterns():
+    requests = []
+    details, failed_ids = asyncio.run(
+        fetch_details(mock_ravelry(requests), [1, 2, 3, 4, 5], bulk=True)
+    )
+
+    assert sorted(request.url.params["ids"] for request in requests) == [
+        "1 2",
+        "3 4",
+        "5",
+    ]
+    assert [pattern_json for pattern_json, _ in details] == [
+        pattern(pattern_id) for pattern_id in [1, 2, 3, 4, 5]
+    ]
+    assert failed_ids == []
+
+
+def test_failed_bulk_requests_fall_back_to_single_requests():
+    requests = []
+    details, failed_ids = asyncio.run(
+        fetch_details(
+            mock_ravelry(requests, failing_bulk=[3], missing=[6]),
+            [1, 2, 3, 4, 5, 6],
+            bulk=True,
+        )
+    )
+
+    single_paths = sorted(
+        request.url.path for request in requests if request.url.path != "/patterns.json"
+    )
+    assert single_paths == ["/patterns/3.json", "/patterns/4.json", "/patterns/6.json"]
+    assert sorted(pattern_json["id"] for pattern_json, _ in details) == [1, 2, 3, 4, 5]
+    assert failed_ids == [6]
+
+
+def test_patterns_with_validators_are_revalidated_one_by_one():
+    requests = []
+    details, failed_ids = asyncio.run(
+        fetch_details(
+            mock_ravelry(requests),
+            [1, 2, 3],
+            bulk=True,
+            validators={2: {"etag": '"old"'}},
+        )
+    )
+
+    single_requests = [
+        request for request in requests if request.url.path != "/patterns.json"
+    ]
+    assert [request.url.path for request in single_requests] == ["/patterns/2.json"]
+    assert single_requests[0].headers["if-none-match"] == '"old"'
+    etags = {pattern_json["id"]: validators.get("etag") for pattern_json, validators in details}
+    assert etags == {1: None, 2: '"2"', 3: None}
+    assert failed_ids == []
+
+
+def test_patterns_without_validators_are_fetched_in_bulk():
+    requests = []
+    asyncio.run(
+        fetch_details(
+            mock_ravelry(requests), [1, 2], bulk=True, validators={1: {}, 2: {}}
+        )
+    )
+
+    assert [request.url.path for request in requests] == ["/patterns.json"]
@@ -1,7 +1,9 @@
 import os
 import json
+import asyncio
+import hashlib
+from typing import AsyncIterator
 import boto3
-import requests
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,14 +16,19 @@ s3_client = boto3.client(
     region_name=os.getenv("AWS_REGION"),
 )
 
+# S3 requires every part of a multipart upload but the last to be at least 5MB
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
 
-def save_json_to_s3(data: dict, permalink: str):
+
+async def save_json_to_s3(data: dict, permalink: str):
     """
 
     Save data to S3 (optional).
+    The blocking boto3 call runs in a worker thread.
     """
     key = f"raw/ravelry/{permalink}/{permalink}.json"
-    s3_client.put_object(
+    await asyncio.to_thread(
+        s3_client.put_object,
         Bucket=S3_BUCKET,
         Key=key,
         Body=json.dumps(data),
@@ -29,15 +36,91 @@ def save_json_to_s3(data: dict, permalink: str):
     print(f"Saved data to S3: {permalink}")
 
 
-def save_file_to_s3(file_url: str, extension: str, permalink: str):
+async def upload_part(key: str, upload_id: str, part_number: int, body: bytes) -> dict:
     """
-    Save a file to S3
+    Upload a single part of a multipart upload
+
+    Returns:
+        dict: The part number and ETag needed to complete the upload
     """
-    file_response = requests.get(file_url, timeout=20)
-    key = f"raw/ravelry/{permalink}/{permalink}.{extension}"
-    s3_client.put_object(
+    response = await asyncio.to_thread(
+        s3_client.upload_part,
         Bucket=S3_BUCKET,
         Key=key,
-        Body=file_response.content,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body,
     )
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+async def stream_file_to_s3(
+    chunks: AsyncIterator[bytes], extension: str, permalink: str, head: bytes = b""
+):
+    """
+    Stream a file to S3 while it is being downloaded.
+    Files smaller than MULTIPART_PART_SIZE are saved with a single put, larger
+    files with a multipart upload, so at most one part is held in memory.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The remaining chunks of the response body
+        extension (str): The extension of the file
+        permalink (str): The permalink of the pattern
+        head (bytes): The beginning of the body, already read from chunks
+
+    Returns:
+        dict: The sha256 of the file content and its size in bytes
+    """
+    key = f"raw/ravelry/{permalink}/{permalink}.{extension}"
+    digest = hashlib.sha256(head)
+    size = len(head)
+    buffer = bytearray(head)
+    upload_id = None
+    parts = []
+    try:
+        async for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+            buffer.extend(chunk)
+            if len(buffer) < MULTIPART_PART_SIZE:
+                continue
+            if upload_id is None:
+                upload = await asyncio.to_thread(
+                    s3_client.create_multipart_upload, Bucket=S3_BUCKET, Key=key
+                )
+                upload_id = upload["UploadId"]
+            parts.append(
+                await upload_part(key, upload_id, len(parts) + 1, bytes(buffer))
+            )
+            buffer.clear()
+
+        if upload_id is None:
+            await asyncio.to_thread(
+                s3_client.put_object,
+                Bucket=S3_BUCKET,
+                Key=key,
+                Body=bytes(buffer),
+            )
+        else:
+            if buffer:
+                parts.append(
+                    await upload_part(key, upload_id, len(parts) + 1, bytes(buffer))
+                )
+            await asyncio.to_thread(
+                s3_client.complete_multipart_upload,
+                Bucket=S3_BUCKET,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except Exception:
+        if upload_id is not None:
+            await asyncio.to_thread(
+                s3_client.abort_multipart_upload,
+                Bucket=S3_BUCKET,
+                Key=key,
+                UploadId=upload_id,
+            )
+        raise
     print(f"Saved file to S3: {permalink}")
+    return {"sha256": digest.hexdigest(), "size": size}
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import re
+from typing import List, Optional
+import openai
+from utils.rate_limiter import TokenBucket
+
+# Account quota of the embedding model. The limits reported by the API in
+# the x-ratelimit-* headers take over after the first response.
+EMBEDDING_RPM = int(os.getenv("EMBEDDING_RPM", 3000))
+EMBEDDING_TPM = int(os.getenv("EMBEDDING_TPM", 1_000_000))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 16))
+EMBEDDING_MAX_ATTEMPTS = int(os.getenv("EMBEDDING_MAX_ATTEMPTS", 5))
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a reset duration like "1s", "6m0s" or "20ms" into seconds
+    """
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * DURATION_SECONDS[unit] for amount, unit in parts)
+
+
+def header_int(headers, name: str) -> Optional[int]:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class AsyncEmbeddingClient:
+    """
+    Embedding client that keeps up to `concurrency` requests in flight while
+    staying within the requests-per-minute and tokens-per-minute budgets.
+
+    Both budgets are token buckets that are corrected from the rate limit
+    headers of every response, and drained until the reported reset time
+    when a request is rate limited, instead of backing off blindly.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        requests_per_minute: int = EMBEDDING_RPM,
+        tokens_per_minute: int = EMBEDDING_TPM,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        max_attempts: int = EMBEDDING_MAX_ATTEMPTS,
+        dimensions: Optional[int] = None,
+    ):
+        """
+        Args:
+            api_key: OpenAI API key
+            model: OpenAI embedding model to use
+            requests_per_minute: Initial requests-per-minute budget
+            tokens_per_minute: Initial tokens-per-minute budget
+            concurrency: Maximum number of requests in flight
+            max_attempts: Attempts per request before giving up
+            dimensions: Shorter vector size requested from text-embedding-3
+                models, the full size if None
+        """
+        # Retries are handled here so that they also go through the buckets
+        self.client = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.model = model
+        self.max_attempts = max_attempts
+        self.request_options = {} if dimensions is None else {"dimensions": dimensions}
+        self.requests = TokenBucket(requests_per_minute / 60, burst=requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60, burst=tokens_per_minute)
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def update_limits(self, headers, rate_limited: bool = False) -> float:
+        """
+        Adjust both buckets to the rate limit headers of a response.
+
+        Args:
+            headers: Response headers
+            rate_limited: Whether the response was a 429
+
+        Returns:
+            float: Seconds until the exhausted budget resets, 0 if none is
+        """
+        wait = 0.0
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = header_int(headers, f"x-ratelimit-limit-{kind}")
+            remaining = header_int(headers, f"x-ratelimit-remaining-{kind}")
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if limit:
+                bucket.update(rate=limit / 60, burst=limit)
+            if remaining is not None:
+                bucket.update(available=remaining)
+
+            if rate_limited and remaining == 0:
+                reset = reset or 1.0
+                # Put the bucket in debt so every caller waits for the reset
+                bucket.update(available=-bucket.rate * reset)
+                wait = max(wait, reset)
+
+        if rate_limited and not wait:
+            # No exhausted budget reported, fall back to retry-after
+            wait = parse_duration(headers.get("retry-after")) or 1.0
+            self.requests.update(available=-self.requests.rate * wait)
+        return wait
+
+    async def embed(self, texts: List[str], token_count: int) -> List[List[float]]:
+        """
+        Embed a list of text chunks in one request.
+
+        Args:
+            texts: Text chunks to embed, within the per-request limits
+            token_count: Number of tokens in `texts`
+
+        Returns:
+            List of embedding vectors in the same order as `texts`
+        """
+        async with self.semaphore:
+            for attempt in range(1, self.max_attempts + 1):
+                await self.requests.acquire()
+                await self.tokens.acquire(min(token_count, self.tokens.burst))
+                try:
+                    raw = await self.client.embeddings.with_raw_response.create(
+                        input=texts, model=self.model, **self.request_options
+                    )
+                except openai.RateLimitError as e:
+                    if attempt == self.max_attempts:
+                        raise
+                    wait = self.update_limits(e.response.headers, rate_limited=True)
+                    print(f"Embedding request rate limited, retrying in {wait:.1f}s")
+                    continue
+                except (openai.APIConnectionError, openai.InternalServerError) as e:
+                    if attempt == self.max_attempts:
+                        raise
+                    print(f"Error getting embeddings, attempt {attempt}: {e}")
+                    await asyncio.sleep(min(60, 2**attempt))
+                    continue
+
+                self.update_limits(raw.headers)
+                response = raw.parse()
+                # The API tags each vector with its input index
+                return [
+                    item.embedding
+                    for item in sorted(response.data, key=lambda d: d.index)
+                ]
+
+    async def close(self):
+        await self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+        return False
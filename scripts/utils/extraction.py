@@ -1,12 +1,21 @@
+import asyncio
 import boto3
+import hashlib
 import os
+import signal
+import time
 import trafilatura
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
 from dotenv import load_dotenv
 from llama_index.core import SimpleDirectoryReader
-from typing import List
+from typing import List, Tuple
 import re
 from llama_parse import LlamaParse
+from pypdf import PdfReader
 from s3fs import S3FileSystem
+from db.cache import ExtractionCache
 from utils.text_embedding_generator import EMBEDDING_GENERATOR
 
 load_dotenv()
@@ -21,6 +30,108 @@ s3_client = boto3.client(
 llamaparse = LlamaParse(api_key=os.getenv("LLAMAINDEX_API_KEY2"), segment_sentences=True)
 s3_fs = S3FileSystem(anon=False, endpoint_url=None)
 
+LOCAL_PDF_WORKERS = int(os.getenv("LOCAL_PDF_WORKERS", os.cpu_count() or 1))
+LOCAL_PDF_TIMEOUT = int(os.getenv("LOCAL_PDF_TIMEOUT", 60))
+# Below this many characters per page, a PDF is most likely scanned images
+LOCAL_PDF_MIN_CHARS_PER_PAGE = int(os.getenv("LOCAL_PDF_MIN_CHARS_PER_PAGE", 100))
+# Max HTML documents in flight, and processes running trafilatura
+HTML_CONCURRENCY = int(os.getenv("HTML_CONCURRENCY", 32))
+HTML_WORKERS = int(os.getenv("HTML_WORKERS", os.cpu_count() or 1))
+
+# Bump when the HTML extraction settings or cleaning change
+HTML_EXTRACTOR_KEY = f"trafilatura-{trafilatura.__version__}-1"
+
+
+def processed_key(permalink: str) -> str:
+    return f"processed/ravelry/{permalink}/{permalink}.txt"
+
+
+EXTRACTION_PREFIX = "processed/by-hash/"
+
+
+def extraction_key(content_hash: str, extractor_key: str) -> str:
+    """
+    S3 key of the text extracted from a raw file. Unlike the processed key of
+    a pattern, it is never overwritten with the text of another file.
+    """
+    return f"{EXTRACTION_PREFIX}{content_hash}-{extractor_key}.txt"
+
+
+def save_processed_text(permalink: str, text: str):
+    """
+    Save the extracted text of a pattern to S3
+    """
+    s3_client.put_object(
+        Bucket=os.getenv("AWS_BUCKET_NAME"),
+        Key=processed_key(permalink),
+        Body=text,
+    )
+
+
+def raw_file_hash(permalink: str, extension: str) -> str:
+    """
+    Compute the sha256 of a raw pattern file stored in S3.
+    Only needed for files scraped before their hash was recorded.
+    """
+    body = s3_client.get_object(
+        Bucket=os.getenv("AWS_BUCKET_NAME"),
+        Key=f"raw/ravelry/{permalink}/{permalink}.{extension}",
+    )["Body"]
+    digest = hashlib.sha256()
+    for chunk in body.iter_chunks(1024 * 1024):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reuse_cached_extraction(
+    cache: ExtractionCache, permalink: str, content_hash: str, extractor_key: str
+) -> bool:
+    """
+    Reuse the text extracted from an identical raw file, copying it to the
+    processed key of the pattern
+
+    Returns:
+        bool: True if the cached text was reused, False if the file needs to
+        be extracted
+    """
+    cached_key = cache.get(content_hash, extractor_key)
+    if cached_key is None:
+        return False
+
+    try:
+        s3_client.copy_object(
+            Bucket=os.getenv("AWS_BUCKET_NAME"),
+            Key=processed_key(permalink),
+            CopySource={"Bucket": os.getenv("AWS_BUCKET_NAME"), "Key": cached_key},
+        )
+    except Exception as e:
+        print(f"Error reusing extracted text for {permalink}: {e}")
+        return False
+    return True
+
+
+def cache_extraction(
+    cache: ExtractionCache, permalink: str, content_hash: str, extractor_key: str
+):
+    """
+    Copy the text just extracted for a pattern to its content-addressed key
+    and record it in the extraction cache
+    """
+    cached_key = extraction_key(content_hash, extractor_key)
+    try:
+        s3_client.copy_object(
+            Bucket=os.getenv("AWS_BUCKET_NAME"),
+            Key=cached_key,
+            CopySource={
+                "Bucket": os.getenv("AWS_BUCKET_NAME"),
+                "Key": processed_key(permalink),
+            },
+        )
+    except Exception as e:
+        print(f"Error caching extracted text for {permalink}: {e}")
+        return
+    cache.put(content_hash, extractor_key, cached_key)
+
 
 def process_pdfs_batch(permalinks: List[str]) -> dict:
     """
@@ -46,11 +157,7 @@ def process_pdfs_batch(permalinks: List[str]) -> dict:
             try:
                 permalink = doc.metadata.get("file_path").split("/")[-2]
                 results[permalink] = clean_text(doc.text)
-                s3_client.put_object(
-                    Bucket=os.getenv("AWS_BUCKET_NAME"),
-                    Key=f"processed/ravelry/{permalink}/{permalink}.txt",
-                    Body=results[permalink],
-                )
+                save_processed_text(permalink, results[permalink])
                 print(f"Successfully processed {permalink}")
             except Exception as e:
                 print(f"Error processing document {doc.id_}: {e}")
@@ -63,31 +170,288 @@ def process_pdfs_batch(permalinks: List[str]) -> dict:
         return results
 
 
-async def process_html_file(permalink: str) -> tuple[str, str]:
+def _raise_timeout(signum, frame):
+    raise TimeoutError("PDF extraction timed out")
+
+
+def extract_pdf_text(pdf_bytes: bytes, timeout: int) -> Tuple[str, int]:
     """
-    Process a single HTML file asynchronously
+    Extract the text of a PDF page by page. Runs in a worker process.
+
+    Args:
+        pdf_bytes (bytes): content of the PDF
+        timeout (int): seconds after which the extraction is interrupted
+
+    Returns:
+        Tuple[str, int]: The text of the PDF and its number of pages
     """
+    # The alarm interrupts the worker itself, so a stuck document frees its
+    # process for the next one
+    use_alarm = hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(timeout)
     try:
-        html_key = f"raw/ravelry/{permalink}/{permalink}.html"
-        html_file = s3_client.get_object(
-            Bucket=os.getenv("AWS_BUCKET_NAME"), Key=html_key
-        )
-        text = html_file.get("Body").read().decode("utf-8")
+        reader = PdfReader(BytesIO(pdf_bytes))
+        pages = [page.extract_text() or "" for page in reader.pages]
+        return "\n".join(pages), len(pages)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
 
-        # Trafilatura is synchronous but lightweight enough to not block
-        pattern = trafilatura.extract(
-            text, include_comments=False, favor_precision=True, deduplicate=True
-        )
 
-        # Write to s3
-        processed_html_key = f"processed/ravelry/{permalink}/{permalink}.txt"
-        s3_client.put_object(
-            Bucket=os.getenv("AWS_BUCKET_NAME"), Key=processed_html_key, Body=pattern
+class PdfExtractor:
+    """
+    Extracts the text of pattern PDFs stored in S3 and saves it next to them.
+    The version is part of the extraction cache key, bump it whenever the
+    output of an extractor changes.
+    """
+
+    name = "base"
+    version = "0"
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.name}-{self.version}"
+
+    def extract(self, permalinks: List[str]) -> dict:
+        """
+        Extract the text of a batch of PDFs
+
+        Args:
+            permalinks (List[str]): permalinks of the patterns
+
+        Returns:
+            dict: The text of every PDF that was extracted, by permalink.
+            Documents that failed are left out.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LlamaParseExtractor(PdfExtractor):
+    """
+    Extracts PDFs with the remote LlamaParse service
+    """
+
+    name = "llamaparse"
+    version = "1"
+
+    def extract(self, permalinks: List[str]) -> dict:
+        return process_pdfs_batch(permalinks)
+
+
+class LocalPdfExtractor(PdfExtractor):
+    """
+    Extracts PDFs with pypdf in a local process pool.
+    Each document is extracted in its own task with its own timeout, so a
+    failing document does not affect the rest of the batch.
+    """
+
+    name = "local"
+    version = "1"
+
+    def __init__(
+        self,
+        max_workers: int = LOCAL_PDF_WORKERS,
+        timeout: int = LOCAL_PDF_TIMEOUT,
+        min_chars_per_page: int = LOCAL_PDF_MIN_CHARS_PER_PAGE,
+    ):
+        """
+        Args:
+            max_workers (int): number of worker processes
+            timeout (int): seconds allowed to extract a single document
+            min_chars_per_page (int): documents with less text are treated as
+                failed, since they are most likely scanned
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.min_chars_per_page = min_chars_per_page
+        self._pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def _download(self, permalink: str) -> bytes:
+        return s3_client.get_object(
+            Bucket=os.getenv("AWS_BUCKET_NAME"),
+            Key=f"raw/ravelry/{permalink}/{permalink}.pdf",
+        )["Body"].read()
+
+    def extract(self, permalinks: List[str]) -> dict:
+        results = {}
+        pool = self._get_pool()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as io_pool:
+            downloads = {io_pool.submit(self._download, p): p for p in permalinks}
+            for download in as_completed(downloads):
+                permalink = downloads[download]
+                try:
+                    future = pool.submit(
+                        extract_pdf_text, download.result(), self.timeout
+                    )
+                    futures[future] = permalink
+                except Exception as e:
+                    print(f"Error downloading PDF for {permalink}: {e}")
+
+        for future in as_completed(futures):
+            permalink = futures[future]
+            try:
+                text, page_count = future.result()
+                if len(text.strip()) < self.min_chars_per_page * max(page_count, 1):
+                    print(f"Too little text in PDF for {permalink}, likely scanned")
+                    continue
+                results[permalink] = clean_text(text)
+                save_processed_text(permalink, results[permalink])
+                print(f"Successfully processed {permalink}")
+            except BrokenProcessPool as e:
+                # A crashed worker breaks the pool, start a new one for the next batch
+                print(f"Error processing PDF for {permalink}: {e}")
+                self._pool = None
+            except Exception as e:
+                print(f"Error processing PDF for {permalink}: {e}")
+
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class FallbackPdfExtractor(PdfExtractor):
+    """
+    Extracts PDFs with a primary extractor, and sends the documents it could
+    not extract to a fallback extractor
+    """
+
+    name = "auto"
+
+    def __init__(self, primary: PdfExtractor, fallback: PdfExtractor):
+        self.primary = primary
+        self.fallback = fallback
+        self.version = f"{primary.name}-{primary.version}+{fallback.name}-{fallback.version}"
+
+    def extract(self, permalinks: List[str]) -> dict:
+        results = self.primary.extract(permalinks)
+        remaining = [p for p in permalinks if p not in results]
+        if remaining:
+            results.update(self.fallback.extract(remaining))
+        return results
+
+    def close(self):
+        self.primary.close()
+        self.fallback.close()
+
+
+def get_pdf_extractor(name: str) -> PdfExtractor:
+    """
+    Get a PDF extractor by name
+
+    Args:
+        name (str): "llamaparse", "local", or "auto" to extract locally and
+            fall back to LlamaParse for documents that fail, like scanned PDFs
+    """
+    if name == "llamaparse":
+        return LlamaParseExtractor()
+    if name == "local":
+        return LocalPdfExtractor()
+    if name == "auto":
+        return FallbackPdfExtractor(LocalPdfExtractor(), LlamaParseExtractor())
+    raise ValueError(f"Unknown PDF extractor: {name}")
+
+
+def extract_html_text(html: str) -> str:
+    """
+    Extract the main text of an HTML page. Runs in a worker process.
+    """
+    return trafilatura.extract(
+        html, include_comments=False, favor_precision=True, deduplicate=True
+    )
+
+
+async def process_html_file(
+    permalink: str,
+    semaphore: asyncio.Semaphore,
+    io_pool: ThreadPoolExecutor,
+    cpu_pool: ProcessPoolExecutor,
+) -> tuple[str, str]:
+    """
+    Process a single HTML file asynchronously.
+    S3 calls run in io_pool and trafilatura runs in cpu_pool, so neither
+    blocks the event loop.
+
+    Args:
+        permalink (str): permalink of the pattern
+        semaphore (asyncio.Semaphore): bounds the number of documents in flight
+        io_pool (ThreadPoolExecutor): runs the blocking boto3 calls
+        cpu_pool (ProcessPoolExecutor): runs the extraction
+    """
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        try:
+            html_key = f"raw/ravelry/{permalink}/{permalink}.html"
+            text = await loop.run_in_executor(
+                io_pool,
+                lambda: s3_client.get_object(
+                    Bucket=os.getenv("AWS_BUCKET_NAME"), Key=html_key
+                )["Body"]
+                .read()
+                .decode("utf-8"),
+            )
+
+            pattern = await loop.run_in_executor(cpu_pool, extract_html_text, text)
+            if pattern is None:
+                print(f"No text extracted from HTML for {permalink}")
+                return (permalink, None)
+
+            # Write to s3
+            await loop.run_in_executor(
+                io_pool, lambda: save_processed_text(permalink, pattern)
+            )
+            return (permalink, pattern)
+        except Exception as e:
+            print(f"Error processing HTML for {permalink}: {e}")
+            return (permalink, None)
+
+
+async def process_html_files(
+    permalinks: List[str],
+    concurrency: int = HTML_CONCURRENCY,
+    workers: int = HTML_WORKERS,
+) -> List[tuple[str, str]]:
+    """
+    Process HTML files concurrently, with at most `concurrency` documents in
+    flight and extraction spread over `workers` processes
+
+    Returns:
+        List[tuple[str, str]]: The permalink and extracted text of every file,
+        the text is None if the extraction failed
+    """
+    if not permalinks:
+        return []
+
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as io_pool, ProcessPoolExecutor(
+        max_workers=workers
+    ) as cpu_pool:
+        results = await asyncio.gather(
+            *(
+                process_html_file(permalink, semaphore, io_pool, cpu_pool)
+                for permalink in permalinks
+            )
         )
-        return (permalink, pattern)
-    except Exception as e:
-        print(f"Error processing HTML for {permalink}: {e}")
-        return (permalink, None)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Processed {len(permalinks)} HTMLs in {elapsed:.1f}s "
+        f"({len(permalinks) / elapsed:.1f} HTML/sec with {workers} workers)"
+    )
+    return results
 
 
 def clean_text(text: str) -> str:
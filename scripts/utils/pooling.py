@@ -0,0 +1,97 @@
+from typing import List, Optional, Sequence
+import numpy as np
+
+# mean: plain average of the chunk vectors
+# weighted: average weighted by the token count of every chunk, so a short
+#   final chunk does not count as much as a full one
+# l2: average of the L2-normalized chunk vectors, normalized again
+POOLING_STRATEGIES = ("mean", "weighted", "l2")
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def pool_embeddings_batch(
+    documents: Sequence[Sequence[Sequence[float]]],
+    token_counts: Optional[Sequence[Sequence[int]]] = None,
+    strategy: str = "mean",
+) -> List[np.ndarray]:
+    """
+    Pool the chunk embeddings of many documents into one vector per document.
+
+    All chunks are stacked into a single float32 matrix and reduced per
+    document with `np.add.reduceat`, so there is no Python loop over chunks
+    or dimensions.
+
+    Args:
+        documents: Chunk embedding vectors of every document
+        token_counts: Token count of every chunk, required for "weighted"
+        strategy: One of POOLING_STRATEGIES
+
+    Returns:
+        List of float32 vectors, one per document. Documents without chunks
+        get an empty vector.
+    """
+    if strategy not in POOLING_STRATEGIES:
+        raise ValueError(f"Unknown pooling strategy: {strategy}")
+    if strategy == "weighted" and token_counts is None:
+        raise ValueError("weighted pooling needs the token count of every chunk")
+
+    lengths = np.array([len(chunks) for chunks in documents], dtype=np.int64)
+    pooled = [np.empty(0, dtype=np.float32) for _ in documents]
+    non_empty = np.flatnonzero(lengths)
+    if not len(non_empty):
+        return pooled
+
+    vectors = np.asarray(
+        [vector for chunks in documents for vector in chunks], dtype=np.float32
+    )
+    if strategy == "l2":
+        vectors = _normalize(vectors)
+
+    if strategy == "weighted":
+        weights = np.asarray(
+            [count for i in non_empty for count in token_counts[i]], dtype=np.float32
+        )
+        if len(weights) != len(vectors):
+            raise ValueError("token_counts must have one count per chunk")
+        vectors = vectors * weights[:, None]
+    else:
+        weights = np.ones(len(vectors), dtype=np.float32)
+
+    # Start row of every non-empty document in the stacked matrix
+    starts = np.concatenate(([0], np.cumsum(lengths[non_empty])[:-1]))
+    sums = np.add.reduceat(vectors, starts, axis=0)
+    totals = np.add.reduceat(weights, starts)
+    means = sums / np.maximum(totals, np.finfo(np.float32).tiny)[:, None]
+    if strategy == "l2":
+        means = _normalize(means)
+
+    for i, mean in zip(non_empty, means):
+        pooled[i] = mean
+    return pooled
+
+
+def pool_embeddings(
+    embeddings: Sequence[Sequence[float]],
+    token_counts: Optional[Sequence[int]] = None,
+    strategy: str = "mean",
+) -> np.ndarray:
+    """
+    Pool the chunk embeddings of a single document.
+
+    Args:
+        embeddings: Chunk embedding vectors
+        token_counts: Token count of every chunk, required for "weighted"
+        strategy: One of POOLING_STRATEGIES
+
+    Returns:
+        float32 vector, empty if there are no chunks
+    """
+    return pool_embeddings_batch(
+        [embeddings],
+        None if token_counts is None else [token_counts],
+        strategy,
+    )[0]
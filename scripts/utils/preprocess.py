@@ -1,5 +1,4 @@
 import re
-import requests
 from models.helpers.pattern_needle_size import PatternNeedleSize
 
 
@@ -77,18 +76,19 @@ def preprocess_pattern(pattern: dict) -> dict:
     return pattern_dict
 
 
-def check_pattern_url_is_active(pattern_url: str) -> bool:
+def check_pattern_content_is_active(content: str) -> bool:
     """
-    Check if the pattern url is active
+    Check if the content served at a pattern url is the pattern, and not a
+    redirect to a parked domain. Parking pages are tiny, so the first few KB
+    of the response are enough.
     Args:
-        pattern_url (str): The url of the pattern
+        content (str): The beginning of the response body
 
     Returns:
         bool: True if the pattern url is active, False otherwise
     """
-    response = requests.get(pattern_url, timeout=20)
     js_redirect_pattern = re.search(
-        r'window\.location\.href\s*=\s*["\'](.*?)["\']', response.text
+        r'window\.location\.href\s*=\s*["\'](.*?)["\']', content
     )
 
     if js_redirect_pattern:
@@ -1,44 +1,491 @@
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
 import os
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CreateAlias,
+    CreateAliasOperation,
+    DeleteAlias,
+    DeleteAliasOperation,
+    Distance,
+    HnswConfigDiff,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+)
 
 load_dotenv()
-# TODO: Write a qdrant client that can be used by other scripts
 
+# Name searched by the agent. After the first full rebuild it is an alias of
+# the collection that holds the points.
+COLLECTION_NAME = "patterns"
+VECTOR_SIZE = 1536  # OpenAI text-embedding-3-small
+# One point per searched collection, whose payload holds the version of its
+# points. Collection metadata would need recent Qdrant clients and servers.
+VERSIONS_COLLECTION_NAME = "collection_versions"
 
-def init_qdrant():
-    qdrant_client = QdrantClient(
-        url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY")
+# How the collection stores and searches vectors. Keys, all optional:
+#   dimensions: vector size, shorter text-embedding-3 vectors are requested
+#       with the `dimensions` parameter of the embeddings API
+#   on_disk: keep the original vectors on disk instead of in RAM
+#   quantization: "int8" (scalar) or "binary", kept in RAM
+#   rescore, oversampling: re-rank oversampling * limit quantized candidates
+#       with the original vectors
+#   m, ef_construct: HNSW graph degree and build-time beam width
+#   hnsw_ef: search-time beam width
+# Compare them with benchmark_qdrant.py before switching.
+COLLECTION_PROFILES = {
+    "default": {},
+    "int8": {
+        "on_disk": True,
+        "quantization": "int8",
+        "rescore": True,
+        "oversampling": 2.0,
+    },
+    "int8-hnsw32": {
+        "on_disk": True,
+        "quantization": "int8",
+        "rescore": True,
+        "oversampling": 2.0,
+        "m": 32,
+        "ef_construct": 256,
+        "hnsw_ef": 128,
+    },
+    "binary": {
+        "on_disk": True,
+        "quantization": "binary",
+        "rescore": True,
+        "oversampling": 3.0,
+    },
+    "int8-512": {
+        "dimensions": 512,
+        "on_disk": True,
+        "quantization": "int8",
+        "rescore": True,
+        "oversampling": 2.0,
+    },
+}
+QDRANT_PROFILE = os.getenv("QDRANT_PROFILE", "default")
+
+# Payload fields filtered on by utils.search, indexed so filters do not scan
+# the whole collection
+PAYLOAD_INDEXES = {
+    "craft": PayloadSchemaType.KEYWORD,
+    "yarn_weight": PayloadSchemaType.KEYWORD,
+    "pattern_categories": PayloadSchemaType.KEYWORD,
+    "pattern_attributes": PayloadSchemaType.KEYWORD,
+    "permalink": PayloadSchemaType.KEYWORD,
+    "needle_sizes_metric": PayloadSchemaType.FLOAT,
+    "yardage": PayloadSchemaType.INTEGER,
+    "yardage_max": PayloadSchemaType.INTEGER,
+    "rating_average": PayloadSchemaType.FLOAT,
+}
+
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "0") == "1"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+# Points per upsert request and requests in flight at once
+QDRANT_UPSERT_BATCH_SIZE = int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", 256))
+QDRANT_UPSERT_PARALLEL = int(os.getenv("QDRANT_UPSERT_PARALLEL", 4))
+# Set to 1 to wait for every batch to be applied instead of acknowledged
+QDRANT_UPSERT_WAIT = os.getenv("QDRANT_UPSERT_WAIT", "0") == "1"
+QDRANT_UPSERT_MAX_ATTEMPTS = int(os.getenv("QDRANT_UPSERT_MAX_ATTEMPTS", 3))
+
+
+def get_qdrant_client(prefer_grpc: bool = QDRANT_PREFER_GRPC) -> QdrantClient:
+    return QdrantClient(
+        url=os.getenv("QDRANT_URL"),
+        api_key=os.getenv("QDRANT_API_KEY"),
+        prefer_grpc=prefer_grpc,
+        grpc_port=QDRANT_GRPC_PORT,
     )
 
-    try:
-        qdrant_client.delete_collection(collection_name="patterns")
-    except Exception:
-        print("collection not found")
 
-    # Create new collection with correct vector size (1536 for OpenAI embeddings)
-    qdrant_client.create_collection(
-        collection_name="patterns",
-        vectors_config=VectorParams(
-            size=1536,  # Updated to match your embedding dimension
+def profile_dimensions(profile: str = QDRANT_PROFILE) -> int:
+    return COLLECTION_PROFILES[profile].get("dimensions", VECTOR_SIZE)
+
+
+def collection_config(profile: str = QDRANT_PROFILE) -> dict:
+    """
+    Returns:
+        dict: create_collection arguments of a profile of COLLECTION_PROFILES
+    """
+    settings = COLLECTION_PROFILES[profile]
+    config = {
+        "vectors_config": VectorParams(
+            size=profile_dimensions(profile),
             distance=Distance.COSINE,
-        ),
+            on_disk=settings.get("on_disk"),
+        )
+    }
+    if "m" in settings or "ef_construct" in settings:
+        config["hnsw_config"] = HnswConfigDiff(
+            m=settings.get("m"), ef_construct=settings.get("ef_construct")
+        )
+    if settings.get("quantization") == "int8":
+        config["quantization_config"] = ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        )
+    elif settings.get("quantization") == "binary":
+        config["quantization_config"] = BinaryQuantization(
+            binary=BinaryQuantizationConfig(always_ram=True)
+        )
+    return config
+
+
+def search_params(profile: str = QDRANT_PROFILE) -> Optional[SearchParams]:
+    """
+    Returns:
+        SearchParams: Search parameters matching a profile, None for the defaults
+    """
+    settings = COLLECTION_PROFILES[profile]
+    quantization = None
+    if settings.get("quantization"):
+        quantization = QuantizationSearchParams(
+            rescore=settings.get("rescore", True),
+            oversampling=settings.get("oversampling"),
+        )
+    if quantization is None and "hnsw_ef" not in settings:
+        return None
+    return SearchParams(hnsw_ef=settings.get("hnsw_ef"), quantization=quantization)
+
+
+def create_payload_indexes(qdrant_client: QdrantClient, collection_name: str):
+    """
+    Create the PAYLOAD_INDEXES missing from a collection
+    """
+    existing = qdrant_client.get_collection(collection_name).payload_schema or {}
+    for field_name, field_schema in PAYLOAD_INDEXES.items():
+        if field_name not in existing:
+            qdrant_client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field_name,
+                field_schema=field_schema,
+            )
+
+
+def create_collection(
+    qdrant_client: QdrantClient, collection_name: str, profile: str = QDRANT_PROFILE
+):
+    qdrant_client.create_collection(
+        collection_name=collection_name, **collection_config(profile)
     )
+    create_payload_indexes(qdrant_client, collection_name)
+
+
+def get_alias_target(qdrant_client: QdrantClient, alias: str) -> Optional[str]:
+    """
+    Returns:
+        str: The collection the alias points to, or None if it is not an alias
+    """
+    for description in qdrant_client.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+
+def versioned_collection_name(alias: str) -> str:
+    return f"{alias}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+
+
+def create_alias(qdrant_client: QdrantClient, collection_name: str, alias: str):
+    qdrant_client.update_collection_aliases(
+        change_aliases_operations=[
+            CreateAliasOperation(
+                create_alias=CreateAlias(collection_name=collection_name, alias_name=alias)
+            )
+        ]
+    )
+
+
+def init_qdrant(collection_name: str = COLLECTION_NAME) -> QdrantClient:
+    """
+    Connect to Qdrant and create the collection if it does not exist yet, or
+    its missing payload indexes. Existing points are kept, see
+    `rebuild_collection` for a full rebuild.
+
+    A new collection is created under a versioned name behind an alias
+    `collection_name`, so rebuilds can always swap the alias atomically.
+    """
+    qdrant_client = get_qdrant_client()
+
+    if get_alias_target(qdrant_client, collection_name) is None and not (
+        qdrant_client.collection_exists(collection_name)
+    ):
+        versioned_name = versioned_collection_name(collection_name)
+        print(f"Creating collection {versioned_name} behind alias {collection_name}")
+        create_collection(qdrant_client, versioned_name)
+        create_alias(qdrant_client, versioned_name, collection_name)
+    else:
+        create_payload_indexes(qdrant_client, collection_name)
 
     return qdrant_client
 
 
-def upsert_to_qdrant(qdrant_client, patterns: List[dict]):
+def version_point_id(collection_name: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"collection-version:{collection_name}"))
+
+
+def bump_collection_version(qdrant_client: QdrantClient, collection_name: str = COLLECTION_NAME) -> str:
+    """
+    Record that the points of a collection changed, which invalidates the
+    search results cached by utils.search_cache
+
+    Returns:
+        str: The new version
+    """
+    version = datetime.now().isoformat()
+    if not qdrant_client.collection_exists(VERSIONS_COLLECTION_NAME):
+        qdrant_client.create_collection(
+            collection_name=VERSIONS_COLLECTION_NAME,
+            vectors_config=VectorParams(size=1, distance=Distance.DOT),
+        )
     qdrant_client.upsert(
-        collection_name="patterns",
+        collection_name=VERSIONS_COLLECTION_NAME,
         points=[
             PointStruct(
-                id=pattern["id"],
-                vector=pattern["embedding"],
-                payload=pattern["metadata"],
+                id=version_point_id(collection_name),
+                vector=[0.0],
+                payload={"collection": collection_name, "version": version},
             )
-            for pattern in patterns
         ],
     )
+    return version
+
+
+def get_collection_version(qdrant_client: QdrantClient, collection_name: str = COLLECTION_NAME) -> str:
+    if not qdrant_client.collection_exists(VERSIONS_COLLECTION_NAME):
+        return "0"
+    points = qdrant_client.retrieve(
+        collection_name=VERSIONS_COLLECTION_NAME,
+        ids=[version_point_id(collection_name)],
+        with_payload=True,
+    )
+    if not points:
+        return "0"
+    return str((points[0].payload or {}).get("version", "0"))
+
+
+def fetch_point_hashes(
+    qdrant_client: QdrantClient, collection_name: str = COLLECTION_NAME, batch_size: int = 1000
+) -> Dict[str, Optional[str]]:
+    """
+    Scroll through the collection without vectors.
+
+    Returns:
+        Dict[str, Optional[str]]: The content hash stored with every point, by point id
+    """
+    hashes = {}
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["content_hash"],
+            with_vectors=False,
+        )
+        for point in points:
+            hashes[str(point.id)] = (point.payload or {}).get("content_hash")
+        if offset is None:
+            return hashes
+
+
+def delete_points(
+    qdrant_client: QdrantClient, ids: List[str], collection_name: str = COLLECTION_NAME
+):
+    if not ids:
+        return
+    qdrant_client.delete(
+        collection_name=collection_name, points_selector=PointIdsList(points=ids)
+    )
+
+
+def pattern_point(pattern: dict) -> PointStruct:
+    return PointStruct(
+        id=pattern["id"],
+        vector=pattern["embedding"],
+        payload={**pattern["metadata"], "content_hash": pattern["content_hash"]},
+    )
+
+
+class QdrantUpsertWriter:
+    """
+    Streams points to Qdrant in fixed size batches with a few batches in
+    flight, so memory stays bounded by `batch_size * parallel` points however
+    many patterns are ingested.
+
+    Unless `wait` is set, batches are only acknowledged by Qdrant and applied
+    in the background. The last batch is always sent with wait=True, and since
+    updates are applied in order, `close` returns once everything is applied.
+    `close` raises if a batch could not be upserted.
+    """
+
+    def __init__(
+        self,
+        qdrant_client: QdrantClient,
+        collection_name: str = COLLECTION_NAME,
+        batch_size: int = QDRANT_UPSERT_BATCH_SIZE,
+        parallel: int = QDRANT_UPSERT_PARALLEL,
+        wait: bool = QDRANT_UPSERT_WAIT,
+        max_attempts: int = QDRANT_UPSERT_MAX_ATTEMPTS,
+    ):
+        """
+        Args:
+            qdrant_client: Qdrant client
+            collection_name: Collection to upsert into
+            batch_size: Number of points per upsert request
+            parallel: Number of upsert requests in flight
+            wait: Whether every request waits for its points to be applied
+            max_attempts: Attempts per batch before it is given up
+        """
+        self.qdrant_client = qdrant_client
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.wait = wait
+        self.max_attempts = max_attempts
+        self.points: List[PointStruct] = []
+        self.upserted = 0
+        self.failed: List[str] = []
+        self._lock = threading.Lock()
+        # Blocks `add` while all workers are busy, instead of queueing batches
+        self._slots = threading.Semaphore(parallel)
+        self._pool = ThreadPoolExecutor(max_workers=parallel)
+
+    def add(self, pattern: dict):
+        """
+        Queue a pattern, sending a batch once more than `batch_size` points
+        are queued. At least one point is always kept for `close`.
+        """
+        self.points.append(pattern_point(pattern))
+        if len(self.points) > self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        batch = self.points[: self.batch_size]
+        self.points = self.points[self.batch_size :]
+        self._slots.acquire()
+        future = self._pool.submit(self._upsert_batch, batch, self.wait)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _upsert_batch(self, batch: List[PointStruct], wait: bool):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.qdrant_client.upsert(
+                    collection_name=self.collection_name, points=batch, wait=wait
+                )
+                with self._lock:
+                    self.upserted += len(batch)
+                return
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    print(f"Error upserting {len(batch)} points, giving up: {e}")
+                    with self._lock:
+                        self.failed.extend(str(point.id) for point in batch)
+                    return
+                print(f"Error upserting {len(batch)} points, attempt {attempt}: {e}")
+                time.sleep(2**attempt)
+
+    def close(self) -> int:
+        """
+        Send the remaining points and wait for every batch.
+
+        Returns:
+            int: The number of upserted points
+
+        Raises:
+            RuntimeError: If some batches were given up
+        """
+        self._pool.shutdown(wait=True)
+        if self.points:
+            batch, self.points = self.points, []
+            self._upsert_batch(batch, wait=True)
+        if self.failed:
+            raise RuntimeError(f"Failed to upsert {len(self.failed)} points")
+        return self.upserted
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def upsert_to_qdrant(
+    qdrant_client, patterns: List[dict], collection_name: str = COLLECTION_NAME
+) -> int:
+    with QdrantUpsertWriter(qdrant_client, collection_name) as writer:
+        for pattern in patterns:
+            writer.add(pattern)
+    return writer.upserted
+
+
+def rebuild_collection(qdrant_client: QdrantClient, fill, alias: str = COLLECTION_NAME):
+    """
+    Build a new collection next to the live one and swap the alias over to it,
+    so searches never see an empty or half-filled collection. The version of
+    the alias is bumped after the swap, since searches cache results by alias.
+
+    A plain collection named `alias`, created before collections were put
+    behind an alias, is migrated by the first rebuild. Qdrant cannot delete a
+    collection and create an alias of the same name in one operation, so the
+    name is missing for the moment between the two calls.
+
+    Args:
+        qdrant_client: Qdrant client
+        fill: Function filling the collection whose name it is given. If it
+            raises, the new collection is deleted and the alias is kept.
+        alias: Name searched by clients
+
+    Returns:
+        Whatever `fill` returns
+    """
+    collection_name = versioned_collection_name(alias)
+    print(f"Rebuilding {alias} into {collection_name}")
+    create_collection(qdrant_client, collection_name)
+    try:
+        result = fill(collection_name)
+    except Exception:
+        # The alias keeps pointing at the previous, complete collection
+        print(f"Rebuild failed, deleting {collection_name}")
+        qdrant_client.delete_collection(collection_name)
+        raise
+
+    previous = get_alias_target(qdrant_client, alias)
+    if previous is None and qdrant_client.collection_exists(alias):
+        # Migrate a plain collection, the alias is created right after
+        qdrant_client.delete_collection(alias)
+
+    operations = [
+        CreateAliasOperation(
+            create_alias=CreateAlias(collection_name=collection_name, alias_name=alias)
+        )
+    ]
+    if previous is not None:
+        operations.insert(
+            0, DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias))
+        )
+    # Both operations are applied atomically
+    qdrant_client.update_collection_aliases(change_aliases_operations=operations)
+
+    # Results cached for the previous collection are stale
+    bump_collection_version(qdrant_client, alias)
+    if previous is not None:
+        qdrant_client.delete_collection(previous)
+    print(f"{alias} now points to {collection_name}")
+    return result
@@ -0,0 +1,87 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Async token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` per second up to `burst`.
+    Every call to `acquire` takes tokens from the bucket, waiting until
+    enough tokens are available.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Args:
+            rate: Number of tokens added to the bucket per second
+            burst: Maximum number of tokens the bucket can hold
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def update(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+        available: Optional[float] = None,
+    ):
+        """
+        Adjust the bucket to limits reported by the server.
+
+        Args:
+            rate: New number of tokens added per second
+            burst: New maximum number of tokens
+            available: Tokens the server still allows; the bucket never holds
+                more than this. A negative value makes the next callers wait
+                until the debt is refilled.
+        """
+        self._refill()
+        if rate:
+            self.rate = rate
+        if burst:
+            self.burst = max(1, burst)
+        if available is not None:
+            self._tokens = min(self._tokens, available)
+        self._tokens = min(self._tokens, self.burst)
+
+    async def acquire(self, tokens: float = 1):
+        """
+        Wait until `tokens` tokens are available and take them from the bucket.
+
+        Args:
+            tokens: Number of tokens to take
+        """
+        if tokens > self.burst:
+            raise ValueError("Cannot acquire more tokens than the burst size")
+
+        # The lock makes waiters queue up in order instead of racing for refills
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
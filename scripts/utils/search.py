@@ -0,0 +1,220 @@
+from typing import List, Optional, Sequence, Tuple
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    FieldCondition,
+    Filter,
+    MatchAny,
+    MatchValue,
+    QueryRequest,
+    Range,
+)
+from utils.qdrant import COLLECTION_NAME, get_qdrant_client, search_params
+from utils.search_cache import SEARCH_CACHE, SearchCache
+from utils.text_embedding_generator import EMBEDDING_GENERATOR
+
+# (min, max) bounds of a range filter, either one may be None
+Bounds = Tuple[Optional[float], Optional[float]]
+
+
+def build_filter(
+    craft: Optional[str] = None,
+    yarn_weight: Optional[str] = None,
+    categories: Optional[Sequence[str]] = None,
+    attributes: Optional[Sequence[str]] = None,
+    needle_metric: Optional[Bounds] = None,
+    yardage: Optional[Bounds] = None,
+    min_rating: Optional[float] = None,
+) -> Optional[Filter]:
+    """
+    Build a Qdrant filter on the indexed payload fields, see PAYLOAD_INDEXES.
+
+    Args:
+        craft: Craft permalink, e.g. "knitting"
+        yarn_weight: Yarn weight class, e.g. "MEDIUM"
+        categories: Category permalinks, a pattern matches if it has any of them
+        attributes: Attribute permalinks, a pattern must have all of them
+        needle_metric: Needle size range in mm, matched by any needle of the pattern
+        yardage: Range of yardage the pattern needs
+        min_rating: Minimum average rating
+
+    Returns:
+        Filter: The filter, or None if no condition is given
+    """
+    conditions = []
+    if craft:
+        conditions.append(FieldCondition(key="craft", match=MatchValue(value=craft)))
+    if yarn_weight:
+        conditions.append(
+            FieldCondition(key="yarn_weight", match=MatchValue(value=yarn_weight))
+        )
+    if categories:
+        conditions.append(
+            FieldCondition(
+                key="pattern_categories",
+                match=MatchAny(any=[category.lower() for category in categories]),
+            )
+        )
+    for attribute in attributes or []:
+        conditions.append(
+            FieldCondition(
+                key="pattern_attributes", match=MatchValue(value=attribute.lower())
+            )
+        )
+    if needle_metric:
+        conditions.append(
+            FieldCondition(
+                key="needle_sizes_metric",
+                range=Range(gte=needle_metric[0], lte=needle_metric[1]),
+            )
+        )
+    if yardage:
+        # The pattern needs between yardage and yardage_max yards
+        if yardage[0] is not None:
+            conditions.append(
+                FieldCondition(key="yardage_max", range=Range(gte=yardage[0]))
+            )
+        if yardage[1] is not None:
+            conditions.append(
+                FieldCondition(key="yardage", range=Range(lte=yardage[1]))
+            )
+    if min_rating is not None:
+        conditions.append(
+            FieldCondition(key="rating_average", range=Range(gte=min_rating))
+        )
+    return Filter(must=conditions) if conditions else None
+
+
+def embed_queries(
+    queries: List[str], cache: Optional[SearchCache] = SEARCH_CACHE
+) -> List[List[float]]:
+    """
+    Embed search queries in as few requests as possible. Embeddings are
+    cached by normalized query, so paging through the results of a query
+    embeds it only once.
+    """
+    if cache is None:
+        return EMBEDDING_GENERATOR.get_query_embeddings(queries)
+    return cache.query_vectors(
+        queries, EMBEDDING_GENERATOR.cache_model, EMBEDDING_GENERATOR.get_query_embeddings
+    )
+
+
+def format_results(points) -> List[dict]:
+    return [
+        {"id": point.id, "score": point.score, "payload": point.payload}
+        for point in points
+    ]
+
+
+def search_patterns(
+    query: Optional[str] = None,
+    limit: int = 10,
+    offset: int = 0,
+    query_filter: Optional[Filter] = None,
+    vector: Optional[List[float]] = None,
+    collection_name: str = COLLECTION_NAME,
+    qdrant_client: Optional[QdrantClient] = None,
+    cache: Optional[SearchCache] = SEARCH_CACHE,
+) -> List[dict]:
+    """
+    Find the patterns closest to a query, optionally filtered.
+
+    Args:
+        query: Text to search for, embedded unless `vector` is given
+        limit: Number of results per page
+        offset: Number of results to skip, `limit * page` for page `page`
+        query_filter: Filter from `build_filter`
+        vector: Embedding of the query, to avoid embedding it again
+        collection_name: Collection to search
+        qdrant_client: Qdrant client, a new one by default
+        cache: Cache of query vectors and results, None to always search
+
+    Returns:
+        List[dict]: id, score and payload of every result, best first
+    """
+    if vector is None:
+        if query is None:
+            raise ValueError("Either query or vector is required")
+        vector = embed_queries([query], cache)[0]
+    qdrant_client = qdrant_client or get_qdrant_client()
+
+    key = None
+    if cache is not None:
+        version = cache.collection_version(qdrant_client, collection_name)
+        key = cache.result_key(vector, query_filter, limit, offset, collection_name, version)
+        results = cache.get_results(key)
+        if results is not None:
+            return results
+
+    response = qdrant_client.query_points(
+        collection_name=collection_name,
+        query=vector,
+        query_filter=query_filter,
+        limit=limit,
+        offset=offset,
+        search_params=search_params(),
+        with_payload=True,
+    )
+    results = format_results(response.points)
+    if key is not None:
+        cache.put_results(key, results)
+    return results
+
+
+def search_patterns_batch(
+    queries: List[str],
+    limit: int = 10,
+    query_filter: Optional[Filter] = None,
+    collection_name: str = COLLECTION_NAME,
+    qdrant_client: Optional[QdrantClient] = None,
+    cache: Optional[SearchCache] = SEARCH_CACHE,
+) -> List[List[dict]]:
+    """
+    Run many searches with one embedding request and one Qdrant request.
+
+    Args:
+        queries: Texts to search for
+        limit: Number of results per query
+        query_filter: Filter applied to every query
+        collection_name: Collection to search
+        qdrant_client: Qdrant client, a new one by default
+        cache: Cache of query vectors and results, None to always search
+
+    Returns:
+        List[List[dict]]: The results of every query, in the same order
+    """
+    if not queries:
+        return []
+    vectors = embed_queries(queries, cache)
+    qdrant_client = qdrant_client or get_qdrant_client()
+
+    results: List[Optional[List[dict]]] = [None] * len(vectors)
+    keys: List[Optional[str]] = [None] * len(vectors)
+    if cache is not None:
+        version = cache.collection_version(qdrant_client, collection_name)
+        for i, vector in enumerate(vectors):
+            keys[i] = cache.result_key(vector, query_filter, limit, 0, collection_name, version)
+            results[i] = cache.get_results(keys[i])
+
+    # Only the queries missing from the cache are searched
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        params = search_params()
+        responses = qdrant_client.query_batch_points(
+            collection_name=collection_name,
+            requests=[
+                QueryRequest(
+                    query=vectors[i],
+                    filter=query_filter,
+                    limit=limit,
+                    params=params,
+                    with_payload=True,
+                )
+                for i in missing
+            ],
+        )
+        for i, response in zip(missing, responses):
+            results[i] = format_results(response.points)
+            if keys[i] is not None:
+                cache.put_results(keys[i], results[i])
+    return results
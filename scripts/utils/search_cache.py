@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+from qdrant_client.models import Filter
+from utils.qdrant import get_collection_version
+
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+# Seconds a search result is served from the cache
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 600))
+# Seconds between checks of the collection version
+SEARCH_CACHE_VERSION_INTERVAL = int(os.getenv("SEARCH_CACHE_VERSION_INTERVAL", 30))
+# SQLite file shared by every process serving searches, disabled if unset
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH")
+
+
+def normalize_query(query: str) -> str:
+    """
+    Lowercase a query and collapse its whitespace, so trivially different
+    spellings of a query share their cache entries
+    """
+    return " ".join(query.lower().split())
+
+
+def vector_key(vector: List[float]) -> str:
+    return hashlib.sha256(array("f", vector).tobytes()).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache whose entries expire after `ttl` seconds
+    """
+
+    def __init__(self, max_size: int = SEARCH_CACHE_SIZE, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SearchCache:
+    """
+    Two-level cache in front of the search path.
+
+    Query vectors are cached by normalized query text and embedding model,
+    in process on top of the persistent embedding cache. Search results are
+    cached by query vector, filter, limit, offset and collection version, in
+    process and optionally in a SQLite file shared between processes. An
+    ingest run bumps the collection version, so older results are never
+    served again.
+
+    Results are kept as JSON and every hit is a new copy, so callers may
+    change them. The SQLite file is opened by the first search using it.
+    """
+
+    def __init__(
+        self,
+        max_size: int = SEARCH_CACHE_SIZE,
+        ttl: float = SEARCH_CACHE_TTL,
+        db_path: Optional[str] = SEARCH_CACHE_PATH,
+        version_interval: float = SEARCH_CACHE_VERSION_INTERVAL,
+    ):
+        """
+        Args:
+            max_size: Number of vectors and of results kept in process
+            ttl: Seconds a search result is served from the cache
+            db_path: SQLite file of the shared tier, none if None
+            version_interval: Seconds between checks of the collection version
+        """
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self.db_path = db_path
+        self.vectors = LRUCache(max_size)
+        self.results = LRUCache(max_size, ttl)
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def connection(self) -> Optional[sqlite3.Connection]:
+        """
+        Connection to the shared tier, opened on first use. Call with the lock held.
+
+        Returns:
+            The connection, or None if there is no shared tier
+        """
+        if self._conn is None and self.db_path:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS search_cache (
+                        key TEXT PRIMARY KEY,
+                        results TEXT,
+                        expires_at REAL
+                    )"""
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS search_cache_expires_at ON search_cache (expires_at)"
+                )
+            self._conn = conn
+        return self._conn
+
+    def query_vectors(
+        self,
+        queries: List[str],
+        model: str,
+        embed: Callable[[List[str]], List[List[float]]],
+    ) -> List[List[float]]:
+        """
+        Vectors of many queries, embedding only the ones not cached.
+
+        Args:
+            queries: Query texts
+            model: Embedding model, part of the key
+            embed: Function embedding a list of texts
+
+        Returns:
+            List of vectors in the same order as `queries`
+        """
+        normalized = [normalize_query(query) for query in queries]
+        # Vectors are kept as tuples and every hit gets its own list
+        vectors = [self.vectors.get(f"{model}:{query}") for query in normalized]
+        missing = sorted({q for q, v in zip(normalized, vectors) if v is None})
+        if missing:
+            embedded = {query: tuple(vector) for query, vector in zip(missing, embed(missing))}
+            for query, vector in embedded.items():
+                self.vectors.put(f"{model}:{query}", vector)
+            vectors = [
+                embedded[query] if vector is None else vector
+                for query, vector in zip(normalized, vectors)
+            ]
+        return [list(vector) for vector in vectors]
+
+    def collection_version(self, qdrant_client, collection_name: str) -> str:
+        """
+        Version of a collection, read from Qdrant at most every
+        `version_interval` seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(collection_name)
+        if cached and cached[1] > now:
+            return cached[0]
+        version = get_collection_version(qdrant_client, collection_name)
+        with self._lock:
+            self._versions[collection_name] = (version, now + self.version_interval)
+        return version
+
+    def result_key(
+        self,
+        vector: List[float],
+        query_filter: Optional[Filter],
+        limit: int,
+        offset: int,
+        collection_name: str,
+        version: str,
+    ) -> str:
+        key = {
+            "vector": vector_key(vector),
+            "filter": query_filter.model_dump(mode="json", exclude_none=True)
+            if query_filter
+            else None,
+            "limit": limit,
+            "offset": offset,
+            "collection": collection_name,
+            "version": version,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get_results(self, key: str) -> Optional[List[dict]]:
+        """
+        Returns:
+            A new copy of the cached results, None on a miss
+        """
+        serialized = self.results.get(key)
+        if serialized is None:
+            with self._lock:
+                conn = self.connection()
+                if conn is None:
+                    return None
+                row = conn.execute(
+                    "SELECT results, expires_at FROM search_cache WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None or row[1] < time.time():
+                return None
+            serialized = row[0]
+            self.results.put(key, serialized)
+        return json.loads(serialized)
+
+    def put_results(self, key: str, results: List[dict]):
+        serialized = json.dumps(results)
+        self.results.put(key, serialized)
+        with self._lock:
+            conn = self.connection()
+            if conn is None:
+                return
+            with conn:
+                conn.execute(
+                    """INSERT INTO search_cache (key, results, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE
+                    SET results = excluded.results, expires_at = excluded.expires_at""",
+                    (key, serialized, time.time() + self.ttl),
+                )
+                # Entries of older collection versions are never read again
+                conn.execute(
+                    "DELETE FROM search_cache WHERE expires_at < ?", (time.time(),)
+                )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+SEARCH_CACHE = SearchCache()
@@ -1,9 +1,44 @@
+import asyncio
 import os
-from typing import List, Dict, Any
-import time
+import re
+from functools import cached_property
+from typing import List, Dict, Any, Hashable, Iterator, Optional, Sequence, Tuple
+import numpy as np
 import openai
 from tenacity import retry, stop_after_attempt, wait_exponential
 import tiktoken
+from db.embedding_cache import EmbeddingCache, chunk_hash
+from utils.embedding_client import EMBEDDING_CONCURRENCY, AsyncEmbeddingClient
+from utils.pooling import POOLING_STRATEGIES, pool_embeddings, pool_embeddings_batch
+from utils.qdrant import COLLECTION_PROFILES, QDRANT_PROFILE
+
+# Per-request limits of the embeddings endpoint: at most 2048 inputs and
+# 300k tokens summed across all inputs
+EMBEDDING_BATCH_INPUTS = int(os.getenv("EMBEDDING_BATCH_INPUTS", 2048))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 300_000))
+# Set to 0 to always call the API
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") != "0"
+# How chunk embeddings are pooled into a document embedding, see utils.pooling
+EMBEDDING_POOLING = os.getenv("EMBEDDING_POOLING", "mean")
+
+# Bump whenever the same settings split a text differently, so that points
+# embedded by an older chunker are re-chunked
+CHUNKER_VERSION = "1"
+# Places where a chunk may end, as patterns matching at the first byte of the
+# next chunk. Row/round markers keep the instructions of a row together.
+BOUNDARY_RULES = {
+    "sentence": re.compile(rb"(?<=[.!?])\s"),
+    "newline": re.compile(rb"(?<=\n)"),
+    "row": re.compile(
+        rb"^[ \t]*(?:rows?|rnds?|rounds?|r)[ \t]*\d+", re.IGNORECASE | re.MULTILINE
+    ),
+}
+# Comma separated BOUNDARY_RULES, in order of preference
+EMBEDDING_CHUNK_BOUNDARIES = tuple(
+    rule.strip()
+    for rule in os.getenv("EMBEDDING_CHUNK_BOUNDARIES", "sentence").split(",")
+    if rule.strip()
+)
 
 
 class TextEmbeddingGenerator:
@@ -13,6 +48,12 @@ class TextEmbeddingGenerator:
         model: str = "text-embedding-3-small",
         chunk_size: int = 8000,
         chunk_overlap: int = 200,
+        batch_inputs: int = EMBEDDING_BATCH_INPUTS,
+        batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        cache: Optional[EmbeddingCache] = None,
+        pooling: str = EMBEDDING_POOLING,
+        boundary_rules: Sequence[str] = EMBEDDING_CHUNK_BOUNDARIES,
+        dimensions: Optional[int] = None,
     ):
         """
         Initialize the embedding generator with OpenAI credentials and parameters.
@@ -22,25 +63,133 @@ class TextEmbeddingGenerator:
             model: OpenAI embedding model to use
             chunk_size: Maximum number of tokens per chunk
             chunk_overlap: Number of overlapping tokens between chunks
+            batch_inputs: Maximum number of chunks sent in one API request
+            batch_tokens: Maximum number of tokens sent in one API request
+            cache: Cache of chunk embeddings checked before calling the API
+            pooling: Strategy used to pool chunk embeddings, one of
+                POOLING_STRATEGIES
+            boundary_rules: Names of BOUNDARY_RULES where chunks may end, in
+                order of preference
+            dimensions: Shorter vector size requested from text-embedding-3
+                models, the full size if None
         """
+        if pooling not in POOLING_STRATEGIES:
+            raise ValueError(f"Unknown pooling strategy: {pooling}")
+        for rule in boundary_rules:
+            if rule not in BOUNDARY_RULES:
+                raise ValueError(f"Unknown chunk boundary rule: {rule}")
+        self.api_key = api_key
         self.client = openai.OpenAI(api_key=api_key)
         self.model = model
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.batch_inputs = batch_inputs
+        self.batch_tokens = batch_tokens
+        self.cache = cache
+        self.pooling = pooling
+        self.boundary_rules = tuple(boundary_rules)
+        self.dimensions = dimensions
+        # Cached vectors of different sizes must not be mixed up
+        self.cache_model = model if dimensions is None else f"{model}@{dimensions}"
         self.encoding = tiktoken.encoding_for_model(model)
 
-    def chunk_text(self, text: str) -> List[str]:
+    @property
+    def request_options(self) -> Dict[str, Any]:
         """
-        Split text into chunks based on token count with overlap.
+        Extra arguments of the embeddings API
+        """
+        return {} if self.dimensions is None else {"dimensions": self.dimensions}
+
+    @property
+    def config_key(self) -> str:
+        """
+        Settings that change the embedding of a document
+        """
+        return ":".join(
+            [
+                self.cache_model,
+                CHUNKER_VERSION,
+                str(self.chunk_size),
+                str(self.chunk_overlap),
+                ",".join(self.boundary_rules),
+                self.pooling,
+            ]
+        )
+
+    @cached_property
+    def token_lengths(self) -> np.ndarray:
+        """
+        Number of bytes of every token of the vocabulary, so token offsets can
+        be computed without a Python loop over the tokens of a text.
+        """
+        lengths = np.zeros(self.encoding.n_vocab, dtype=np.int64)
+        for token in range(self.encoding.n_vocab):
+            try:
+                lengths[token] = len(self.encoding.decode_single_token_bytes(token))
+            except KeyError:
+                # Unused ids between the regular and the special tokens
+                pass
+        return lengths
+
+    def chunk_boundaries(self, data: bytes, offsets: np.ndarray) -> List[np.ndarray]:
+        """
+        Token indexes where a chunk may end, for every boundary rule.
 
         Args:
-            text: Input text to be chunked
+            data: UTF-8 bytes of the tokens
+            offsets: Byte offset of every token in `data`
 
         Returns:
-            List of text chunks
+            Sorted token indexes for every rule in `boundary_rules`
+        """
+        boundaries = []
+        for rule in self.boundary_rules:
+            starts = np.fromiter(
+                (match.start() for match in BOUNDARY_RULES[rule].finditer(data)),
+                dtype=np.int64,
+            )
+            # First token starting at or after every boundary
+            boundaries.append(np.unique(np.searchsorted(offsets, starts)))
+        return boundaries
+
+    def iter_chunk_spans(self, text: str) -> Iterator[Tuple[str, int]]:
+        """
+        Split text into chunks based on token count with overlap, lazily.
+
+        The text is tokenized once and chunk boundaries are looked up from
+        the byte offsets of the tokens, so every chunk is a slice of the
+        token bytes and nothing is encoded again.
+
+        A chunk ends at the last boundary of the first rule that has one in
+        the second half of the window, else at the last boundary of any rule,
+        else after `chunk_size` tokens. A chunk is always longer than the
+        overlap, so the window moves forward.
+
+        The chunks differ from the ones of the period-based chunker kept in
+        benchmark_chunker.py, even with the default "sentence" rule: a
+        sentence ends at ".", "!" or "?" followed by whitespace rather than at
+        any period, boundaries closer than the overlap are skipped, and
+        boundaries in the first half of the window are only used when no rule
+        has a later one.
+
+        Args:
+            text: Input text to be chunked
+
+        Yields:
+            Tuple[str, int]: Every chunk and its number of tokens
         """
         tokens = self.encoding.encode(text)
-        chunks = []
+        if not tokens:
+            return
+        data = self.encoding.decode_bytes(tokens)
+        # offsets[i] is where token i starts, offsets[-1] is the end of data
+        offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum(self.token_lengths[np.asarray(tokens)], out=offsets[1:])
+        boundaries = self.chunk_boundaries(data, offsets)
+
+        def decode(start: int, end: int) -> str:
+            # Same as encoding.decode, a chunk may cut a character in two
+            return data[offsets[start] : offsets[end]].decode("utf-8", errors="replace")
 
         start_idx = 0
         while start_idx < len(tokens):
@@ -48,21 +197,45 @@ class TextEmbeddingGenerator:
             end_idx = start_idx + self.chunk_size
 
             if end_idx >= len(tokens):
-                chunks.append(self.encoding.decode(tokens[start_idx:]))
-                break
-
-            # Move end index to nearest sentence boundary if possible
-            decode_chunk = self.encoding.decode(tokens[start_idx:end_idx])
-            last_period = decode_chunk.rfind(".")
-            if last_period != -1:
-                # Adjust end_idx to match token boundary after the period
-                partial_chunk = decode_chunk[: last_period + 1]
-                end_idx = start_idx + len(self.encoding.encode(partial_chunk))
-
-            chunks.append(self.encoding.decode(tokens[start_idx:end_idx]))
+                yield decode(start_idx, len(tokens)), len(tokens) - start_idx
+                return
+
+            # Ends closer than the overlap would not move the window forward
+            earliest = start_idx + self.chunk_overlap + 1
+            preferred = max(earliest, start_idx + self.chunk_size // 2)
+            best = None
+            for indexes in boundaries:
+                position = np.searchsorted(indexes, end_idx, side="right")
+                last = int(indexes[position - 1]) if position else -1
+                if last >= preferred:
+                    best = last
+                    break
+                if last >= earliest and (best is None or last > best):
+                    best = last
+            if best is not None:
+                end_idx = best
+
+            yield decode(start_idx, end_idx), end_idx - start_idx
             start_idx = end_idx - self.chunk_overlap
 
-        return chunks
+    def iter_chunks(self, text: str) -> Iterator[str]:
+        """
+        Yield the chunks of a text lazily, see `iter_chunk_spans`.
+        """
+        for chunk, _ in self.iter_chunk_spans(text):
+            yield chunk
+
+    def chunk_text(self, text: str) -> List[str]:
+        """
+        Split text into chunks based on token count with overlap.
+
+        Args:
+            text: Input text to be chunked
+
+        Returns:
+            List of text chunks
+        """
+        return list(self.iter_chunks(text))
 
     @retry(wait=wait_exponential(min=1, max=60), stop=stop_after_attempt(5))
     def get_embedding(self, text: str) -> List[float]:
@@ -76,29 +249,254 @@ class TextEmbeddingGenerator:
         Returns:
             List of embedding values
         """
+        if self.cache:
+            cached = self.cache.get(self.cache_model, text)
+            if cached is not None:
+                return cached
         try:
-            response = self.client.embeddings.create(input=text, model=self.model)
-            return response.data[0].embedding
+            response = self.client.embeddings.create(
+                input=text, model=self.model, **self.request_options
+            )
+            embedding = response.data[0].embedding
+            if self.cache:
+                self.cache.put(self.cache_model, text, embedding)
+            return embedding
         except Exception as e:
             print(f"Error getting embedding: {e}")
             raise
 
-    def get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+    @retry(wait=wait_exponential(min=1, max=60), stop=stop_after_attempt(5))
+    def get_embeddings_request(self, texts: List[str]) -> List[List[float]]:
+        """
+        Get embeddings for a list of text chunks in a single API request.
+        Includes retry logic for API failures.
+
+        Args:
+            texts: Text chunks to embed, within the per-request limits
+
+        Returns:
+            List of embedding vectors in the same order as `texts`
+        """
+        try:
+            response = self.client.embeddings.create(
+                input=texts, model=self.model, **self.request_options
+            )
+            # The API tags each vector with its input index
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except Exception as e:
+            print(f"Error getting embeddings for {len(texts)} chunks: {e}")
+            raise
+
+    def pack_batches(self, token_counts: List[int]) -> List[List[int]]:
+        """
+        Pack chunks into requests that respect the input count and token budget.
+
+        Chunks are packed in order so chunks of the same document stay close
+        together, and a new request is started as soon as the next chunk
+        would not fit.
+
+        Args:
+            token_counts: Token count of every chunk
+
+        Returns:
+            List of requests, each a list of chunk indexes
+        """
+        batches = []
+        batch, batch_tokens = [], 0
+        for i, count in enumerate(token_counts):
+            if batch and (
+                len(batch) >= self.batch_inputs
+                or batch_tokens + count > self.batch_tokens
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += count
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def plan_requests(
+        self, texts: List[str], token_counts: Optional[List[int]] = None
+    ) -> Tuple[List[str], Dict[str, List[float]], List[Tuple[List[str], int]]]:
+        """
+        Look up text chunks in the cache and pack the others into requests.
+
+        Repeated chunks are only sent once.
+
+        Args:
+            texts: Text chunks to embed
+            token_counts: Token count of every chunk, if already known
+
+        Returns:
+            The hash of every chunk, the cached embeddings by hash, and the
+            requests to send as (chunks, token count)
+        """
+        hashes = [chunk_hash(text) for text in texts]
+        found = self.cache.get_many(self.cache_model, texts) if self.cache else {}
+
+        # Unique chunks that still need an API call, by hash
+        if token_counts is None:
+            token_counts = [None] * len(texts)
+        missing = {}
+        for key, text, count in zip(hashes, texts, token_counts):
+            if key not in found and key not in missing:
+                missing[key] = (text, count)
+        if self.cache:
+            print(f"Embedding cache: {len(found)} hits, {len(missing)} misses")
+
+        missing_texts = [text for text, _ in missing.values()]
+        missing_counts = [
+            len(self.encoding.encode(text)) if count is None else count
+            for text, count in missing.values()
+        ]
+        requests = [
+            (
+                [missing_texts[i] for i in batch],
+                sum(missing_counts[i] for i in batch),
+            )
+            for batch in self.pack_batches(missing_counts)
+        ]
+        return hashes, found, requests
+
+    def store_embeddings(
+        self, found: Dict[str, List[float]], texts: List[str], vectors: List[List[float]]
+    ):
+        """
+        Record the embeddings returned for a request and cache them.
+        """
+        if self.cache:
+            self.cache.put_many(self.cache_model, texts, vectors)
+        for text, vector in zip(texts, vectors):
+            found[chunk_hash(text)] = vector
+
+    def embed_packed(
+        self, texts: List[str], token_counts: Optional[List[int]] = None
+    ) -> List[Optional[List[float]]]:
+        """
+        Embed text chunks with as few API requests as the limits allow.
+
+        Chunks found in the cache, and repeated chunks, are not sent. A
+        request that still fails after retries leaves `None` for its chunks
+        so the remaining requests are not lost.
+
+        Args:
+            texts: Text chunks to embed
+            token_counts: Token count of every chunk, if already known
+
+        Returns:
+            List of embedding vectors (or None) in the same order as `texts`
+        """
+        hashes, found, requests = self.plan_requests(texts, token_counts)
+        for n, (batch_texts, _) in enumerate(requests, start=1):
+            try:
+                vectors = self.get_embeddings_request(batch_texts)
+            except Exception as e:
+                print(f"Embedding request {n}/{len(requests)} failed: {e}")
+                continue
+            self.store_embeddings(found, batch_texts, vectors)
+
+        return [found.get(key) for key in hashes]
+
+    def async_client(self, concurrency: int = EMBEDDING_CONCURRENCY) -> AsyncEmbeddingClient:
+        """
+        Client for `embed_packed_async`. Reusing one client across calls keeps
+        the rate limits it learned from the response headers.
+        """
+        return AsyncEmbeddingClient(
+            self.api_key,
+            self.model,
+            concurrency=concurrency,
+            dimensions=self.dimensions,
+        )
+
+    async def embed_packed_async(
+        self,
+        texts: List[str],
+        token_counts: Optional[List[int]] = None,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        client: Optional[AsyncEmbeddingClient] = None,
+    ) -> List[Optional[List[float]]]:
+        """
+        Same as `embed_packed`, with the requests sent concurrently by an
+        AsyncEmbeddingClient that follows the account rate limits.
+
+        Args:
+            texts: Text chunks to embed
+            token_counts: Token count of every chunk, if already known
+            concurrency: Maximum number of requests in flight, for a new client
+            client: Client from `async_client`, a new one is used by default
+
+        Returns:
+            List of embedding vectors (or None) in the same order as `texts`
+        """
+        hashes, found, requests = self.plan_requests(texts, token_counts)
+        if client is None:
+            async with self.async_client(concurrency) as client:
+                await self.send_requests(client, found, requests)
+        else:
+            await self.send_requests(client, found, requests)
+        return [found.get(key) for key in hashes]
+
+    async def send_requests(
+        self,
+        client: AsyncEmbeddingClient,
+        found: Dict[str, List[float]],
+        requests: List[Tuple[List[str], int]],
+    ):
+        """
+        Send planned requests concurrently and store their embeddings in `found`
+        """
+
+        async def send(n: int, batch_texts: List[str], batch_tokens: int):
+            try:
+                vectors = await client.embed(batch_texts, batch_tokens)
+            except Exception as e:
+                print(f"Embedding request {n}/{len(requests)} failed: {e}")
+                return
+            self.store_embeddings(found, batch_texts, vectors)
+
+        await asyncio.gather(
+            *(
+                send(n, batch_texts, batch_tokens)
+                for n, (batch_texts, batch_tokens) in enumerate(requests, start=1)
+            )
+        )
+
+    def get_embeddings_batch(
+        self, texts: List[str], token_counts: Optional[List[int]] = None
+    ) -> List[List[float]]:
         """
         Get embeddings for multiple text chunks.
 
         Args:
             texts: List of text chunks to embed
+            token_counts: Token count of every chunk, if already known
 
         Returns:
             List of embedding vectors
         """
+        embeddings = self.embed_packed(texts, token_counts)
+        if any(embedding is None for embedding in embeddings):
+            raise RuntimeError("Failed to embed all chunks")
+        return embeddings
+
+    def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embed search queries. Queries bypass the chunk embedding cache, which
+        only holds pattern chunks.
+
+        Args:
+            queries: Query texts
+
+        Returns:
+            List of embedding vectors in the same order as `queries`
+        """
+        token_counts = [len(self.encoding.encode(query)) for query in queries]
         embeddings = []
-        for chunk in texts:
-            embedding = self.get_embedding(chunk)
-            embeddings.append(embedding)
-            # Simple rate limiting
-            time.sleep(0.1)
+        # Batches hold consecutive queries, so the order is kept
+        for batch in self.pack_batches(token_counts):
+            embeddings += self.get_embeddings_request([queries[i] for i in batch])
         return embeddings
 
     def process_large_text(self, text: str) -> Dict[str, Any]:
@@ -111,11 +509,15 @@ class TextEmbeddingGenerator:
         Returns:
             Dictionary containing chunks and their embeddings
         """
-        chunks = self.chunk_text(text)
-        embeddings = self.get_embeddings_batch(chunks)
+        chunks, token_counts = [], []
+        for chunk, count in self.iter_chunk_spans(text):
+            chunks.append(chunk)
+            token_counts.append(count)
+        embeddings = self.get_embeddings_batch(chunks, token_counts)
 
         return {
             "chunks": chunks,
+            "token_counts": token_counts,
             "embeddings": embeddings,
             "chunk_size": self.chunk_size,
             "chunk_overlap": self.chunk_overlap,
@@ -124,30 +526,126 @@ class TextEmbeddingGenerator:
 
     def get_document_embeddings(self, text: str) -> List[float]:
         """
-        Get embeddings for an entire document by averaging chunk embeddings.
+        Get embeddings for an entire document by pooling chunk embeddings.
 
         Args:
             text (str): Text to get embeddings for
 
         Returns:
-            List[float]: Average embedding vector for the entire document
+            List[float]: Pooled embedding vector for the entire document
         """
         embedding_data = self.process_large_text(text)
+        return pool_embeddings(
+            embedding_data["embeddings"],
+            embedding_data["token_counts"],
+            self.pooling,
+        ).tolist()
+
+    def chunk_documents(
+        self, documents: Dict[Hashable, str]
+    ) -> Tuple[List[Hashable], List[str], List[int]]:
+        """
+        Chunk many documents.
+
+        Returns:
+            The document key, the text and the token count of every chunk
+        """
+        owners = []
+        texts = []
+        counts = []
+        for key, text in documents.items():
+            for chunk, count in self.iter_chunk_spans(text):
+                owners.append(key)
+                texts.append(chunk)
+                counts.append(count)
+
+        print(f"Embedding {len(texts)} chunks from {len(documents)} documents")
+        return owners, texts, counts
+
+    def pool_documents(
+        self,
+        documents: Dict[Hashable, str],
+        owners: List[Hashable],
+        counts: List[int],
+        embeddings: List[Optional[List[float]]],
+    ) -> Dict[Hashable, List[float]]:
+        """
+        Map chunk embeddings back to their document and pool them in one call.
+
+        Returns:
+            Mapping of document key to its pooled embedding vector. Documents
+            with a chunk that could not be embedded are left out.
+        """
+        chunk_embeddings: Dict[Hashable, List[Optional[List[float]]]] = {
+            key: [] for key in documents
+        }
+        counts_by_key: Dict[Hashable, List[int]] = {key: [] for key in documents}
+        for key, count, embedding in zip(owners, counts, embeddings):
+            chunk_embeddings[key].append(embedding)
+            counts_by_key[key].append(count)
+
+        keys = []
+        for key, embeddings in chunk_embeddings.items():
+            if any(embedding is None for embedding in embeddings):
+                print(f"Skipping {key}, not all chunks were embedded")
+                continue
+            keys.append(key)
 
-        # Get the average of the embeddings
-        embeddings = embedding_data.get("embeddings")
-        if not embeddings:
-            return []
+        pooled = pool_embeddings_batch(
+            [chunk_embeddings[key] for key in keys],
+            [counts_by_key[key] for key in keys],
+            self.pooling,
+        )
+        return {key: vector.tolist() for key, vector in zip(keys, pooled)}
+
+    def get_document_embeddings_batch(
+        self, documents: Dict[Hashable, str]
+    ) -> Dict[Hashable, List[float]]:
+        """
+        Get embeddings for many documents at once.
 
-        # Calculate element-wise sum and divide by number of vectors
-        vector_length = len(embeddings[0])
-        avg_embedding = [0.0] * vector_length
-        for embedding in embeddings:
-            for i in range(vector_length):
-                avg_embedding[i] += embedding[i]
+        Chunks from all documents are packed together into as few API requests
+        as possible, and the vectors are mapped back to their document and
+        pooled together in one call.
 
-        avg_embedding = [x / len(embeddings) for x in avg_embedding]
-        return avg_embedding
+        Args:
+            documents: Mapping of document key to text
+
+        Returns:
+            Mapping of document key to its pooled embedding vector. Documents
+            with a chunk that could not be embedded are left out.
+        """
+        owners, texts, counts = self.chunk_documents(documents)
+        embeddings = self.embed_packed(texts, counts)
+        return self.pool_documents(documents, owners, counts, embeddings)
+
+    async def get_document_embeddings_batch_async(
+        self,
+        documents: Dict[Hashable, str],
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        client: Optional[AsyncEmbeddingClient] = None,
+    ) -> Dict[Hashable, List[float]]:
+        """
+        Same as `get_document_embeddings_batch`, with many requests in flight
+        at once within the account rate limits.
+
+        Args:
+            documents: Mapping of document key to text
+            concurrency: Maximum number of requests in flight, for a new client
+            client: Client from `async_client`, a new one is used by default
+
+        Returns:
+            Mapping of document key to its pooled embedding vector. Documents
+            with a chunk that could not be embedded are left out.
+        """
+        owners, texts, counts = self.chunk_documents(documents)
+        embeddings = await self.embed_packed_async(texts, counts, concurrency, client)
+        return self.pool_documents(documents, owners, counts, embeddings)
 
 
-EMBEDDING_GENERATOR = TextEmbeddingGenerator(os.getenv("OPENAI_API_KEY"))
+EMBEDDING_GENERATOR = TextEmbeddingGenerator(
+    os.getenv("OPENAI_API_KEY"),
+    cache=EmbeddingCache() if EMBEDDING_CACHE else None,
+    # Vectors must match the size of the collection
+    dimensions=COLLECTION_PROFILES[QDRANT_PROFILE].get("dimensions"),
+)